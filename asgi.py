@@ -0,0 +1,342 @@
+"""
+ASGI variant of index.py: the same routes served by async handlers.
+
+Usage: uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+Route bodies come from commands.py, shared with the Flask app. Connections are checked out
+of a psycopg 3 AsyncConnectionPool and WhatsApp notifications go through Twilio's aiohttp
+client, so a request waiting on Neon or Twilio parks a coroutine instead of holding a worker.
+Metrics labels, SQL profiling and query budgets match index.py route for route.
+"""
+import os
+import time
+import logging
+from contextlib import asynccontextmanager
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route, Match
+from twilio.rest import Client
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from metrics import (
+    render_metrics, REQUEST_LATENCY, REQUESTS_IN_FLIGHT, REQUEST_ERRORS, DB_CONNECT_LATENCY,
+    DB_ERRORS, TWILIO_LATENCY, TWILIO_ERRORS
+)
+from sql_profiler import (
+    start_profile, end_profile, current_profile, check_budget, record_statement, ENFORCE_QUERY_BUDGET
+)
+from index import (
+    DATABASE_URL, DATABASE_SSLMODE, TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_WHATSAPP_FROM,
+    METRICS_TOKEN, QUERY_BUDGETS
+)
+import commands
+
+DATABASE_POOL_MIN_SIZE = int(os.getenv("DATABASE_POOL_MIN_SIZE", 1))
+DATABASE_POOL_MAX_SIZE = int(os.getenv("DATABASE_POOL_MAX_SIZE", 10))
+
+# Created on startup, inside the event loop that aiohttp binds its session to.
+client = None
+
+
+class AsyncProfilingCursor(psycopg.AsyncCursor):
+    """Async counterpart of sql_profiler.ProfilingCursor, plus the rollback commands.py expects."""
+    async def execute(self, query, params=None, **kwargs):
+        check_budget(query)
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        except Exception:
+            DB_ERRORS.inc("query")
+            raise
+        finally:
+            record_statement(query, time.perf_counter() - start)
+
+    async def rollback(self):
+        await self.connection.rollback()
+
+
+pool = AsyncConnectionPool(
+    DATABASE_URL or "",
+    min_size=DATABASE_POOL_MIN_SIZE,
+    max_size=DATABASE_POOL_MAX_SIZE,
+    # Neon's pooled endpoint runs PgBouncer in transaction mode, which cannot keep prepared statements.
+    kwargs={"sslmode": DATABASE_SSLMODE, "cursor_factory": AsyncProfilingCursor, "prepare_threshold": None},
+    open=False,
+)
+
+
+@asynccontextmanager
+async def transaction():
+    """A cursor on a pooled connection; commits when the block succeeds, rolls back otherwise."""
+    start = time.perf_counter()
+    try:
+        conn = await pool.getconn()
+    except Exception:
+        DB_ERRORS.inc("connect")
+        raise
+    finally:
+        DB_CONNECT_LATENCY.observe(time.perf_counter() - start)
+    try:
+        async with conn.cursor() as cur:
+            yield cur
+        await conn.commit()
+    except BaseException:
+        await conn.rollback()
+        raise
+    finally:
+        await pool.putconn(conn)
+
+
+async def send_whatsapp_notification(body: str, to):
+    """Async version of index.send_whatsapp_notification."""
+    try:
+        with TWILIO_LATENCY.time("messages.create"):
+            message = await client.messages.create_async(
+                body=body,
+                from_=TWILIO_WHATSAPP_FROM,
+                to=to
+            )
+        print(f"WhatsApp message sent! SID: {message.sid}")
+        return message.sid
+    except Exception as e:
+        TWILIO_ERRORS.inc("messages.create")
+        print(f"Error sending WhatsApp message: {e}")
+        return None
+
+
+# ---------- Routes ----------
+async def hello(request):
+    return PlainTextResponse("Hello! Welcome to the WhatsApp Expense App")
+
+async def metrics(request):
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return JSONResponse({"error": "Unauthorized"}, 401)
+    return Response(render_metrics(), 200, media_type='text/plain; version=0.0.4')
+
+async def get_user_transactions(request):
+    user_id = request.path_params['user_id']
+    date_filter = request.query_params.get('date')  # Optional: YYYY-MM-DD
+    page = int(request.query_params.get('page', 1))
+    limit = int(request.query_params.get('limit', 100))
+
+    try:
+        async with transaction() as cur:
+            body, status = await commands.user_transactions(cur, user_id, date_filter, page, limit)
+        return JSONResponse(body, status)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+async def search_user_transactions(request):
+    try:
+        async with transaction() as cur:
+            body, status = await commands.transaction_search(cur, request.path_params['user_id'], request.query_params)
+        return JSONResponse(body, status)
+    except Exception:
+        logging.exception("Error searching transactions")
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+async def notify_user(request):
+    data = await request.json()
+    body = data.get('message')
+    if not body:
+        return JSONResponse({"error": "Missing 'message' or 'to' in request body"}, 400)
+    try:
+        async with transaction() as cur:
+            user_info = await commands.get_user_by_user_id(request.path_params['user_id'], cur)
+        if not user_info:
+            return JSONResponse({"error": "User not found"}, 400)
+
+        # The connection is back in the pool before the Twilio round trip.
+        result = await send_whatsapp_notification(body, f"whatsapp:{user_info['phone_number']}")
+        if result and result.startswith("SM"):
+            return JSONResponse({"status": "success", "sid": result})
+        return JSONResponse({"status": "failed", "error": result}, 500)
+    except Exception as e:
+        logging.exception(f"Error fetching email config data {e}")
+        return JSONResponse({"error": f"Internal server error {e}"}, 500)
+
+async def get_email_configs(request):
+    try:
+        async with transaction() as cur:
+            return JSONResponse(await commands.email_configs(cur))
+    except Exception:
+        logging.exception("Error fetching email config data")
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+async def twilio_webhook(request):
+    incoming_msg, phone_number, message_sid = commands.parse_webhook((await request.body()).decode())
+    try:
+        async with transaction() as cur:
+            reply = await commands.webhook_reply(cur, phone_number, incoming_msg, message_sid)
+        return Response(reply, 200, media_type='application/xml')
+    except Exception as e:
+        logging.exception("Exception in Twilio webhook handler")
+        logging.exception(e)
+        return Response(commands.error_reply(), 200, media_type='application/xml')
+
+async def add_staged_transaction(request):
+    data = await request.json()
+    if not all(field in data for field in commands.STAGED_REQUIRED_FIELDS):
+        return JSONResponse({"error": "Missing required fields"}, 400)
+    try:
+        async with transaction() as cur:
+            body, status = await commands.add_staged_transaction(cur, data)
+        return JSONResponse(body, status)
+    except Exception as e:
+        logging.exception(e)
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+async def update_email_config_fetch_info(request):
+    data = await request.json()
+    last_fetched_email_id = data.get("last_fetched_email_id")
+    last_email_fetch_time = data.get("last_email_fetch_time")
+    lease_token = data.get("lease_token")
+    if not last_fetched_email_id and not last_email_fetch_time:
+        return JSONResponse({"error": "At least one of 'last_fetched_email_id' or 'last_email_fetch_time' is required"}, 400)
+    try:
+        async with transaction() as cur:
+            updated = await commands.update_email_config_fetch_info(
+                cur, request.path_params['user_id'], request.path_params['email_config_id'],
+                last_fetched_email_id, last_email_fetch_time, lease_token)
+        if lease_token and not updated:
+            return JSONResponse({"error": "Lease lost"}, 409)
+        return JSONResponse({"message": "Email config updated successfully"}, 200)
+    except Exception:
+        logging.exception("Error updating email config fetch info")
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+async def lease_reader_jobs(request):
+    data = await request.json()
+    worker_id = data.get("worker_id")
+    if not worker_id:
+        return JSONResponse({"error": "Missing 'worker_id'"}, 400)
+    try:
+        async with transaction() as cur:
+            return JSONResponse(await commands.lease_reader_jobs(
+                cur, worker_id, data.get("limit", 1), data.get("lease_seconds", commands.READER_LEASE_SECONDS)))
+    except Exception:
+        logging.exception("Error leasing reader jobs")
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+async def heartbeat_reader_job(request):
+    data = await request.json()
+    if not data.get("lease_token"):
+        return JSONResponse({"error": "Missing 'lease_token'"}, 400)
+    try:
+        async with transaction() as cur:
+            body, status = await commands.heartbeat_reader_job(
+                cur, request.path_params['email_config_id'], data["lease_token"],
+                data.get("lease_seconds", commands.READER_LEASE_SECONDS))
+        return JSONResponse(body, status)
+    except Exception:
+        logging.exception("Error renewing reader job lease")
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+async def complete_reader_job(request):
+    data = await request.json()
+    if not data.get("lease_token"):
+        return JSONResponse({"error": "Missing 'lease_token'"}, 400)
+    try:
+        async with transaction() as cur:
+            body, status = await commands.complete_reader_job(
+                cur, request.path_params['email_config_id'], data["lease_token"], data.get("error"))
+        return JSONResponse(body, status)
+    except Exception:
+        logging.exception("Error completing reader job")
+        return JSONResponse({"error": "Internal server error"}, 500)
+
+
+# Route names are the Flask rules so both apps report the same metric labels and budgets.
+routes = [
+    Route('/', hello, methods=['GET'], name='/'),
+    Route('/', twilio_webhook, methods=['POST'], name='/'),
+    Route('/metrics', metrics, methods=['GET'], name='/metrics'),
+    Route('/api/users/{user_id:int}/transactions', get_user_transactions, methods=['GET'],
+          name='/api/users/<int:user_id>/transactions'),
+    Route('/api/users/{user_id:int}/transactions/search', search_user_transactions, methods=['GET'],
+          name='/api/users/<int:user_id>/transactions/search'),
+    Route('/api/users/{user_id}/notify-whatsapp', notify_user, methods=['POST'],
+          name='/api/users/<user_id>/notify-whatsapp'),
+    Route('/api/email-configs', get_email_configs, methods=['GET'], name='/api/email-configs'),
+    Route('/api/staged-transactions', add_staged_transaction, methods=['POST'], name='/api/staged-transactions'),
+    Route('/api/users/{user_id:int}/email-configs/{email_config_id:int}', update_email_config_fetch_info,
+          methods=['PUT'], name='/api/users/<int:user_id>/email-configs/<int:email_config_id>'),
+    Route('/api/reader-jobs/lease', lease_reader_jobs, methods=['POST'], name='/api/reader-jobs/lease'),
+    Route('/api/reader-jobs/{email_config_id:int}/heartbeat', heartbeat_reader_job, methods=['POST'],
+          name='/api/reader-jobs/<int:email_config_id>/heartbeat'),
+    Route('/api/reader-jobs/{email_config_id:int}/complete', complete_reader_job, methods=['POST'],
+          name='/api/reader-jobs/<int:email_config_id>/complete'),
+]
+
+
+# ---------- Request instrumentation ----------
+def route_label(scope):
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.name
+    return "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """The before/after/teardown request hooks of index.py as ASGI middleware."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route = route_label(scope)
+        start = time.perf_counter()
+        token = start_profile(route, QUERY_BUDGETS.get(route))
+        profile = current_profile()
+        REQUESTS_IN_FLIGHT.inc(route)
+        status = 500
+        replaced = False
+
+        async def send_with_profile(message):
+            nonlocal status, replaced
+            if replaced:
+                return
+            if message["type"] == "http.response.start":
+                # Handlers swallow exceptions into friendly replies, so surface budget overruns here.
+                if ENFORCE_QUERY_BUDGET and profile.over_budget:
+                    replaced = True
+                    status = 500
+                    response = JSONResponse({"error": f"Query budget exceeded: {profile.query_count} > {profile.budget}"}, 500,
+                                            headers={"X-Query-Count": str(profile.query_count)})
+                    await response(scope, receive, send)
+                    return
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []),
+                                                  (b"x-query-count", str(profile.query_count).encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start, scope["method"], route, str(status))
+            if status >= 500:
+                REQUEST_ERRORS.inc(route)
+            REQUESTS_IN_FLIGHT.dec(route)
+            end_profile(token)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    await pool.open()
+    if client is None:
+        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=AsyncTwilioHttpClient())
+    try:
+        yield
+    finally:
+        if isinstance(client, Client):
+            await client.http_client.close()
+        await pool.close()
+
+
+app = Starlette(routes=routes, lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
@@ -0,0 +1,931 @@
+"""
+Performance benchmarks for the expense app.
+
+Usage: python benchmark.py <name> [args...]
+Run without arguments to list the available benchmarks.
+"""
+import os
+import sys
+import json
+import time
+import random
+import re
+import logging
+from datetime import datetime, date, timedelta
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+MERCHANTS = ["SWIGGY", "ZOMATO", "AMAZON PAY", "UBER INDIA", "BIG BAZAAR", "IRCTC", "NETFLIX", "DMART",
+             "APOLLO PHARMACY", "INDIAN OIL", "BLINKIT", "MAKEMYTRIP"]
+ITEMS = ["food", "groceries", "travel", "fuel", "medicine", "shopping", "bills", "tea", None]
+
+
+def timed(fn, *args, repeat=5, **kwargs):
+    """Runs fn repeat times and returns (best seconds, last result)."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def fake_transactions(count, days=730, seed=42):
+    rng = random.Random(seed)
+    start = date.today() - timedelta(days=days)
+    for _ in range(count):
+        yield {
+            "date": start + timedelta(days=rng.randrange(days)),
+            "action": rng.choice(["DEBIT", "DEBIT", "DEBIT", "CREDIT", "add"]),
+            "item": rng.choice(ITEMS),
+            "amount": round(rng.uniform(5, 5000), 2),
+            "merchant": rng.choice(MERCHANTS),
+            "event": rng.choice(["daily", "goa trip", "office"]),
+        }
+
+
+# ---------- Report formats ----------
+def bench_report_formats(rows="100000"):
+    """Write time, read time and file size of each report format."""
+    import pandas as pd
+    from report_formats import FORMATS, monthly_summary
+
+    df = pd.DataFrame(fake_transactions(int(rows)))
+    df["date"] = pd.to_datetime(df["date"])
+    summary = monthly_summary(df)
+
+    logging.info(f"{'format':<10}{'write (s)':>12}{'read (s)':>12}{'size (KiB)':>14}   ({len(df)} rows)")
+    for fmt in FORMATS.values():
+        write_s, data = timed(fmt.write, df, summary, repeat=3)
+        read_s, _ = timed(fmt.read, data, repeat=3)
+        logging.info(f"{fmt.name:<10}{write_s:>12.3f}{read_s:>12.3f}{len(data) / 1024:>14.1f}")
+
+
+# ---------- Database ----------
+def get_bench_conn():
+    """
+    Connects to the scratch database in BENCHMARK_DATABASE_URL and brings its schema up to date.
+    Never point this at production: seeding truncates every table.
+    """
+    from migrations import get_conn, migrate
+
+    url = os.getenv("BENCHMARK_DATABASE_URL")
+    if not url:
+        sys.exit("Set BENCHMARK_DATABASE_URL to a scratch database (it will be truncated and seeded).")
+    conn = get_conn(url)
+    migrate(conn)
+    return conn
+
+
+EVENT_TOTALS_FROM_TRANSACTIONS = """
+    UPDATE events e SET total_spent = t.spent, item_count = t.items, last_activity_at = t.last_at
+    FROM (
+        SELECT event_id, COALESCE(SUM(amount) FILTER (WHERE upper(action) IS DISTINCT FROM 'CREDIT'), 0) AS spent,
+               count(*) AS items, max(created_at) AS last_at
+        FROM transactions WHERE event_id IS NOT NULL GROUP BY event_id
+    ) t
+    WHERE e.event_id = t.event_id
+"""
+
+
+def seed_database(conn, users=2000, rows_per_event=100, days=730):
+    """Fills the schema with users, 3 events each and rows_per_event transactions per event spread over days."""
+    from partitions import create_partitions, PARTITION_MONTHS_AHEAD
+
+    start = time.perf_counter()
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                TRUNCATE users, events, transactions, user_settings, user_email_configs, email_patterns,
+                         user_email_patterns, reader_jobs, webhook_messages, reply_cache, merchant_rules
+                RESTART IDENTITY CASCADE
+            """)
+            create_partitions(cur, date.today() - timedelta(days=days), date.today() + timedelta(days=31 * PARTITION_MONTHS_AHEAD))
+            cur.execute("""
+                INSERT INTO users (name, phone_number)
+                SELECT 'user ' || i, '+91' || lpad(i::text, 10, '0') FROM generate_series(1, %s) i
+            """, (users,))
+            cur.execute("""
+                INSERT INTO events (event_name, user_id)
+                SELECT e, u.id FROM users u, unnest(ARRAY['daily', 'goa trip', 'office']) e
+            """)
+            cur.execute("""
+                INSERT INTO user_settings (user_id, key, value)
+                SELECT e.user_id, 'current_event_id', min(e.event_id)::text FROM events e GROUP BY e.user_id
+                UNION ALL SELECT id, 'pending_add', 'false' FROM users
+                UNION ALL SELECT id, 'add_buffer', '[]' FROM users
+            """)
+            cur.execute("""
+                INSERT INTO transactions (event_id, user_id, date, action, item, amount, merchant, created_at)
+                SELECT e.event_id, e.user_id, d, (ARRAY['DEBIT', 'DEBIT', 'CREDIT', 'add'])[1 + floor(random() * 4)::int],
+                       CASE WHEN random() < 0.02 THEN NULL
+                            ELSE (ARRAY['food', 'groceries', 'travel', 'fuel', 'tea', 'bills'])[1 + floor(random() * 6)::int] END,
+                       round((random() * 5000)::numeric, 2),
+                       (%s::text[])[1 + floor(random() * %s)::int], d
+                FROM events e, generate_series(1, %s) g,
+                     LATERAL (SELECT current_date - (random() * %s)::int + g * 0 AS d) dates
+            """, (MERCHANTS, len(MERCHANTS), rows_per_event, days))
+            # Bulk-loaded rows bypass the app's INSERTs, so fill the running totals like migration 10 does
+            cur.execute(EVENT_TOTALS_FROM_TRANSACTIONS)
+            cur.execute("""
+                INSERT INTO email_patterns (type, pattern_text, source)
+                SELECT t, '(?P<amount>[0-9,.]+)', 'alerts@hdfcbank.net'
+                FROM unnest(ARRAY['UPI_DEBIT', 'UPI_CREDIT', 'BANK_CREDIT', 'CARD_DEBIT']) t
+            """)
+            # Config ids start far from user ids so a config id passed off as a user id shows
+            cur.execute("SELECT setval(pg_get_serial_sequence('user_email_configs', 'id'), 1000000)")
+            cur.execute("""
+                INSERT INTO user_email_configs (user_id, email, provider)
+                SELECT id, 'user' || id || '@example.com', 'gmail' FROM users
+            """)
+            cur.execute("""
+                INSERT INTO user_email_patterns (user_email_config_id, email_pattern_id, active)
+                SELECT c.id, p.id, random() < 0.25 FROM user_email_configs c, email_patterns p
+            """)
+            # Enough webhook ids, shared replies and merchant rules that a sequential scan of them shows
+            cur.execute("""
+                INSERT INTO webhook_messages (message_sid, reply, created_at)
+                SELECT 'SM' || md5(i::text), '<Response/>', now() - random() * interval '2 days'
+                FROM generate_series(1, %s) i
+            """, (users * 5,))
+            cur.execute("""
+                INSERT INTO reply_cache (cache_key, reply, expires_at)
+                SELECT 'seed:' || i, '<Response/>', now() + (random() - 0.5) * interval '10 minutes'
+                FROM generate_series(1, %s) i
+            """, (users * 5,))
+            cur.execute("""
+                INSERT INTO merchant_rules (user_id, merchant, item)
+                SELECT u.id, merchant_key(m), (ARRAY['food', 'travel', 'bills', 'groceries'])[1 + floor(random() * 4)::int]
+                FROM users u, unnest(%s::text[]) m
+            """, (MERCHANTS,))
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("VACUUM ANALYZE")
+    conn.autocommit = False
+    logging.info(f"Seeded {users} users x 3 events x {rows_per_event} transactions in {time.perf_counter() - start:.1f}s")
+
+
+def sample_user(cur):
+    """Picks a user from the middle of the seeded set along with their current event."""
+    cur.execute("""
+        SELECT u.id, u.phone_number, min(e.event_id) FROM users u JOIN events e ON e.user_id = u.id
+        WHERE u.id = (SELECT (max(id) + min(id)) / 2 FROM users) GROUP BY u.id, u.phone_number
+    """)
+    user_id, phone_number, event_id = cur.fetchone()
+    # A pending row to tag (any row when none is pending) and an email config to checkpoint
+    cur.execute("SELECT tran_id, date FROM transactions WHERE user_id = %s ORDER BY item IS NULL DESC LIMIT 1", (user_id,))
+    pending = cur.fetchone()
+    cur.execute("SELECT id, user_id FROM user_email_configs ORDER BY abs(user_id - %s) LIMIT 1", (user_id,))
+    email_config = cur.fetchone()
+    day = date.today() - timedelta(days=3)
+    return {"user_id": user_id, "phone_number": phone_number, "event_id": event_id,
+            "pending": [pending[0], pending[1].isoformat()] if pending else None, "email_config": email_config,
+            "date": day, "next_date": day + timedelta(days=1),
+            "month": day.replace(day=1), "next_month": (day.replace(day=28) + timedelta(days=4)).replace(day=1)}
+
+
+def hot_queries(s):
+    """
+    (name, sql, params, tables that must not be sequentially scanned) for each query the app
+    issues on a hot path, recorded from the commands.py coroutines that run it.
+    """
+    import uuid
+    import reply_cache
+    from commands import (handle_incoming_message, tag_transactions, add_staged_transaction, user_transactions,
+                          email_configs, claim_webhook_message, store_webhook_reply, lease_reader_jobs,
+                          update_email_config_fetch_info)
+
+    user_id, event_id, phone_number = s["user_id"], s["event_id"], s["phone_number"]
+    settings = [("current_event_id", str(event_id)), ("pending_add", "false"), ("add_buffer", "[]"),
+                ("cache_generation", str(time.time_ns()))]
+
+    def command(message, *results):
+        # After the user and settings lookups, the first statement the command runs itself
+        statements = recorded(lambda c: handle_incoming_message(c, phone_number, message), [(user_id,)], settings, *results)
+        return [st for st in statements[2:] if "reply_cache" not in st[0]][0]
+
+    staged = recorded(lambda c: add_staged_transaction(c, {
+        "user_id": user_id, "transaction_date": date.today(), "amount": 120, "action": "DEBIT", "merchant": "Swiggy"}),
+        [(user_id, "bench", phone_number)], settings, [(0, None)])
+    api = recorded(lambda c: user_transactions(c, user_id, None, 1, 100), [(user_id, "bench", phone_number)], [], [(0,)])
+    api_date = recorded(lambda c: user_transactions(c, user_id, s["date"].isoformat(), 1, 100),
+                        [(user_id, "bench", phone_number)], [], [(0,)])
+    # A retry: the claim finds the id taken and reads the stored reply
+    claim = recorded(lambda c: claim_webhook_message(c, "SMbench"))
+    # The shared tier only queries Postgres when REPLY_CACHE_SHARED is on
+    shared, reply_cache.REPLY_CACHE_SHARED = reply_cache.REPLY_CACHE_SHARED, True
+    try:
+        cache_lookup = recorded(lambda c: reply_cache.get_reply(c, f"bench:{time.time_ns()}"))
+    finally:
+        reply_cache.REPLY_CACHE_SHARED = shared
+    email_config_id, email_user_id = s["email_config"]
+    return [
+        ("user by phone", *recorded(lambda c: handle_incoming_message(c, phone_number, "list"))[0], ["users"]),
+        ("user by id", *staged[0], ["users"]),
+        ("user settings", *staged[1], ["user_settings"]),
+        ("reply cache lookup", *cache_lookup[0], ["reply_cache"]),
+        ("list", *command("list"), ["events"]),
+        ("switch", *command("switch daily"), ["events"]),
+        ("show pending", *command("show pending"), ["transactions"]),
+        ("show", *command(f"show date {s['date']}"), ["transactions", "events"]),
+        ("summary", *command(f"summary date {s['date']}", [(None,)]), ["transactions"]),
+        ("summary month", *command(f"summary month {s['month']:%Y-%m}"), ["transactions"]),
+        ("tag", *recorded(lambda c: tag_transactions(c, user_id, [s["pending"]], "food"))[0],
+         ["transactions", "events", "merchant_rules"]),
+        ("staged insert", *staged[2], ["transactions", "events", "merchant_rules"]),
+        ("api transactions", *api[1], ["transactions", "events"]),
+        ("api transactions date", *api_date[1], ["transactions", "events"]),
+        ("api transactions count", *api[2], ["transactions"]),
+        ("find", *search_sql(user_id, "swiggy"), ["transactions"]),
+        ("webhook claim", *claim[0], ["webhook_messages"]),
+        ("webhook retry reply", *claim[1], ["webhook_messages"]),
+        ("webhook store", *recorded(lambda c: store_webhook_reply(c, "SMbench", "<Response/>"))[0],
+         ["webhook_messages"]),
+        # Lists every active config by design, so reading them all is the plan
+        ("email configs", *recorded(lambda c: email_configs(c))[0], []),
+        ("reader job lease", *recorded(lambda c: lease_reader_jobs(c, "bench"))[0],
+         ["reader_jobs", "user_email_configs", "users", "user_email_patterns"]),
+        ("email checkpoint", *recorded(lambda c: update_email_config_fetch_info(
+            c, email_user_id, email_config_id, "bench-message", datetime.now(), str(uuid.uuid4())))[0],
+         ["user_email_configs", "reader_jobs"]),
+    ]
+
+
+class _RecordingCursor:
+    """
+    Captures the statements a commands.py coroutine issues instead of running them. Each
+    statement is answered with the next of results (rows), then with no rows.
+    """
+    def __init__(self, *results):
+        self.statements, self.results, self.rows = [], list(results), []
+
+    async def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+        self.rows = list(self.results.pop(0)) if self.results else []
+
+    async def fetchall(self):
+        return self.rows
+
+    async def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    async def rollback(self):
+        pass
+
+
+def recorded(call, *results):
+    """The (sql, params) statements of call(c) on a _RecordingCursor that answers them with results in order."""
+    from commands import run_sync
+
+    cursor = _RecordingCursor(*results)
+    run_sync(call(cursor))
+    return cursor.statements
+
+
+def search_sql(user_id, text, limit=21, **filters):
+    """(sql, params) of commands.search_transactions, so plans are taken on the exact query."""
+    from commands import search_transactions
+
+    return recorded(lambda c: search_transactions(c, user_id, text, limit, **filters))[-1]
+
+
+def index_names(plan):
+    names = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        names += index_names(child)
+    return names
+
+
+def parent_indexes(cur, names):
+    """Names of the partitioned indexes that the given partition indexes belong to."""
+    cur.execute("""
+        SELECT DISTINCT COALESCE(p.relname, c.relname) FROM pg_class c
+        LEFT JOIN pg_inherits i ON i.inhrelid = c.oid LEFT JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relname = ANY(%s) ORDER BY 1
+    """, (list(set(names)),))
+    return [row[0] for row in cur.fetchall()]
+
+
+def explain(cur, sql, params):
+    """Returns (plan, execution ms) from EXPLAIN ANALYZE."""
+    cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+    result = cur.fetchone()[0]
+    result = json.loads(result) if isinstance(result, str) else result
+    return result[0]["Plan"], result[0]["Execution Time"]
+
+
+_MONTHLY_PARTITION = re.compile(r"_y\d{4}m\d{2}$")
+SEQ_SCAN_MIN_ROWS = 1000
+
+
+def seq_scans(plan, tables, min_rows=SEQ_SCAN_MIN_ROWS):
+    """
+    Relations from tables (or their monthly partitions) that the plan reads with a sequential scan
+    of at least min_rows rows. Smaller scans, such as next month's empty partition, are cheaper
+    than an index lookup.
+    """
+    found = []
+    relation = _MONTHLY_PARTITION.sub("", plan.get("Relation Name", ""))
+    examined = plan.get("Actual Rows", 0) + plan.get("Rows Removed by Filter", 0)
+    if plan.get("Node Type") == "Seq Scan" and relation in tables and examined >= min_rows:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found += seq_scans(child, tables, min_rows)
+    return found
+
+
+def bench_query_plans(users="2000", rows_per_event="100"):
+    """Seeds a large dataset and fails if any hot query falls back to a sequential scan."""
+    conn = get_bench_conn()
+    seed_database(conn, int(users), int(rows_per_event))
+    failures = []
+    with conn.cursor() as cur:
+        queries = hot_queries(sample_user(cur))
+        # A table seeded below the threshold could be scanned end to end without being reported
+        for table in sorted({table for _, _, _, tables in queries for table in tables}):
+            cur.execute(f"SELECT count(*) FROM {table}")
+            rows = cur.fetchone()[0]
+            if rows < SEQ_SCAN_MIN_ROWS:
+                failures.append(f"{table}: only {rows} rows seeded, below the {SEQ_SCAN_MIN_ROWS} a sequential scan is checked from")
+        for name, sql, params, tables in queries:
+            plan, ms = explain(cur, sql, params)
+            scans = seq_scans(plan, tables)
+            logging.info(f"{'SEQ SCAN' if scans else 'ok':<10}{name:<26}{ms:>9.2f} ms  {plan['Node Type']}")
+            if scans:
+                failures.append(f"{name}: sequential scan on {', '.join(scans)}")
+    conn.rollback()
+    conn.close()
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+def median_ms(cur, sql, params, repeat=7):
+    times = sorted(explain(cur, sql, params)[1] for _ in range(repeat))
+    return times[len(times) // 2]
+
+
+def bench_date_filters(users="200", rows_per_event="1500", days="1825"):
+    """Old text/timestamp date predicates against half-open ranges on the DATE column."""
+    conn = get_bench_conn()
+    seed_database(conn, int(users), int(rows_per_event), int(days))
+    with conn.cursor() as cur:
+        # The pre-migration shape: date stored as text next to a timestamp copy, with the same indexes.
+        cur.execute("""
+            CREATE TEMP TABLE legacy_transactions AS
+            SELECT tran_id, event_id, user_id, date::text AS date, date::timestamp AS date_ts, item, amount, action, merchant
+            FROM transactions
+        """)
+        cur.execute("CREATE INDEX ON legacy_transactions (user_id, event_id, date)")
+        cur.execute("CREATE INDEX ON legacy_transactions (user_id, date_ts)")
+        cur.execute("ANALYZE legacy_transactions")
+
+        s = sample_user(cur)
+        day, month = s["date"], s["month"]
+        cases = [
+            ("show",
+             "SELECT item, amount FROM legacy_transactions WHERE event_id = %s AND date = %s and user_id = %s",
+             (s["event_id"], day.isoformat(), s["user_id"]),
+             "SELECT item, amount FROM transactions WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s",
+             (s["event_id"], day, s["next_date"], s["user_id"])),
+            ("summary month",
+             "SELECT date, SUM(amount) FROM legacy_transactions WHERE event_id = %s AND date LIKE %s and user_id = %s GROUP BY date",
+             (s["event_id"], month.strftime("%Y-%m") + "%", s["user_id"]),
+             "SELECT date, SUM(amount) FROM transactions WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s GROUP BY date ORDER BY date",
+             (s["event_id"], month, s["next_month"], s["user_id"])),
+            ("api transactions",
+             "SELECT date_ts, action, amount FROM legacy_transactions WHERE user_id = %s AND DATE(date_ts) = %s ORDER BY date_ts DESC LIMIT 100",
+             (s["user_id"], day.isoformat()),
+             "SELECT date, action, amount FROM transactions WHERE user_id = %s AND date >= %s AND date < %s ORDER BY date DESC LIMIT 100",
+             (s["user_id"], day, s["next_date"])),
+        ]
+        logging.info(f"{'query':<20}{'before (ms)':>14}{'after (ms)':>14}")
+        for name, old_sql, old_params, new_sql, new_params in cases:
+            before, after = median_ms(cur, old_sql, old_params), median_ms(cur, new_sql, new_params)
+            logging.info(f"{name:<20}{before:>14.3f}{after:>14.3f}")
+    conn.rollback()
+    conn.close()
+
+
+def planned_ms(cur, sql, params, repeat=7):
+    """Median planning plus execution time; planning grows with the number of partitions."""
+    times = []
+    for _ in range(repeat):
+        cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+        result = cur.fetchone()[0]
+        result = json.loads(result) if isinstance(result, str) else result
+        times.append(result[0]["Planning Time"] + result[0]["Execution Time"])
+    return sorted(times)[len(times) // 2]
+
+
+def bench_partitions(users="200", years="1,2,4,8", retain_months="24"):
+    """
+    show, summary and paged reads as history grows: monthly partitions with all history attached,
+    partitions after archiving all but retain_months, and one flat table with the same indexes.
+    """
+    from partitions import archive_partitions, add_months, monthly_partitions
+
+    conn = get_bench_conn()
+    queries = [
+        ("show", "SELECT item, amount FROM {t} WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s",
+         lambda s: (s["event_id"], s["date"], s["next_date"], s["user_id"])),
+        ("summary month", "SELECT date, SUM(amount) FROM {t} WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s GROUP BY date ORDER BY date",
+         lambda s: (s["event_id"], s["month"], s["next_month"], s["user_id"])),
+        ("show pending", "SELECT tran_id, merchant, amount, date FROM {t} WHERE user_id = %s AND event_id = %s AND item IS NULL",
+         lambda s: (s["user_id"], s["event_id"])),
+        ("api page 1", "SELECT date, action, amount, merchant, item FROM {t} WHERE user_id = %s ORDER BY date DESC LIMIT 100 OFFSET 0",
+         lambda s: (s["user_id"],)),
+        ("api page 5", "SELECT date, action, amount, merchant, item FROM {t} WHERE user_id = %s ORDER BY date DESC LIMIT 100 OFFSET 400",
+         lambda s: (s["user_id"],)),
+        ("api count", "SELECT COUNT(*) FROM {t} WHERE user_id = %s", lambda s: (s["user_id"],)),
+    ]
+    logging.info(f"{'years':<7}{'rows':>10}  {'query':<15}{'partitioned':>13}{f'retain {retain_months}m':>13}{'flat':>10}   (ms)")
+    for history in [int(y) for y in years.split(",")]:
+        # Start from the partitions this history needs, then seed the same daily volume per event
+        with conn:
+            with conn.cursor() as cur:
+                for name, _, _ in monthly_partitions(cur):
+                    cur.execute(f'DROP TABLE "{name}"')
+        seed_database(conn, int(users), 365 * history, 365 * history)
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS bench_flat_transactions")
+                cur.execute("CREATE TABLE bench_flat_transactions AS SELECT * FROM transactions")
+                cur.execute("CREATE INDEX ON bench_flat_transactions (user_id, event_id, date)")
+                cur.execute("CREATE INDEX ON bench_flat_transactions (user_id, date)")
+                cur.execute("CREATE INDEX ON bench_flat_transactions (user_id, event_id, date) WHERE item IS NULL")
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE bench_flat_transactions")
+        conn.autocommit = False
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM bench_flat_transactions")
+            rows = cur.fetchone()[0]
+            s = sample_user(cur)
+            results = {name: [planned_ms(cur, sql.format(t="transactions"), params(s))] for name, sql, params in queries}
+            # Archive inside this transaction; the rollback below re-attaches everything.
+            archive_partitions(cur, add_months(date.today().replace(day=1), -int(retain_months)))
+            for name, sql, params in queries:
+                results[name].append(planned_ms(cur, sql.format(t="transactions"), params(s)))
+                results[name].append(planned_ms(cur, sql.format(t="bench_flat_transactions"), params(s)))
+                logging.info(f"{history:<7}{rows:>10}  {name:<15}" + "".join(f"{ms:>13.3f}" for ms in results[name][:2])
+                             + f"{results[name][2]:>10.3f}")
+        conn.rollback()
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS bench_flat_transactions")
+    conn.close()
+
+
+def bench_merchant_rules(users="2000", merchants_per_user="250", inserts="2000"):
+    """Merchant rule lookup at scale and its cost inside the staged-transaction INSERT."""
+    conn = get_bench_conn()
+    seed_database(conn, int(users), 10, 90)
+    start = time.perf_counter()
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO merchant_rules (user_id, merchant, item, hits)
+                SELECT u.id, merchant_key('MERCHANT ' || m), (ARRAY['food', 'travel', 'bills', 'groceries'])[1 + m %% 4], 1 + m %% 7
+                FROM users u, generate_series(1, %s) m
+                ON CONFLICT DO NOTHING
+            """, (int(merchants_per_user),))
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("VACUUM ANALYZE merchant_rules")
+    conn.autocommit = False
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM merchant_rules")
+        rules = cur.fetchone()[0]
+        logging.info(f"{rules} rules for {users} users loaded in {time.perf_counter() - start:.1f}s")
+        s = sample_user(cur)
+        lookup = "SELECT item FROM merchant_rules WHERE user_id = %s AND merchant = merchant_key(%s)"
+        plan, _ = explain(cur, lookup, (s["user_id"], "merchant 42"))
+        logging.info(f"lookup plan: {plan['Node Type']} using {plan.get('Index Name')}, "
+                     f"{median_ms(cur, lookup, (s['user_id'], 'merchant 42')):.3f} ms")
+
+        rng = random.Random(7)
+        # Half the merchants have a rule, half are new to the user
+        rows = [(s["event_id"], date.today(), "DEBIT", 100, rng.randint(1, int(users)),
+                 f"Merchant  {rng.randint(1, 2 * int(merchants_per_user))}") for _ in range(int(inserts))]
+        plain_sql = """
+            INSERT INTO transactions (event_id, date, action, amount, user_id, merchant)
+            VALUES (%s, %s, %s, %s, %s, %s) RETURNING tran_id
+        """
+        rule_sql = """
+            INSERT INTO transactions (event_id, date, action, amount, user_id, merchant, item)
+            VALUES (%s, %s, %s, %s, %s, %s,
+                    (SELECT item FROM merchant_rules WHERE user_id = %s AND merchant = merchant_key(%s)))
+            RETURNING tran_id, item
+        """
+        timings = {}
+        filled = 0
+        for name, sql in (("plain insert", plain_sql), ("insert + rule", rule_sql)):
+            start = time.perf_counter()
+            for row in rows:
+                cur.execute(sql, row + (row[4], row[5]) if sql is rule_sql else row)
+                if sql is rule_sql and cur.fetchone()[1] is not None:
+                    filled += 1
+            timings[name] = (time.perf_counter() - start) / len(rows) * 1e6
+        conn.rollback()
+        for name, us in timings.items():
+            logging.info(f"{name:<16}{us:>10.1f} us/row")
+        logging.info(f"auto-filled {filled}/{len(rows)} rows ({filled / len(rows):.0%})")
+    conn.close()
+
+
+def bench_search(users="2000", rows_per_event="500", page_size="20"):
+    """
+    Merchant/item search with and without the trigram GIN indexes, and a walk through every
+    keyset page of one search; fails if the pages skip or repeat a row.
+    """
+    from commands import SyncCursor, run_sync, search_transactions, search_key
+
+    conn = get_bench_conn()
+    seed_database(conn, int(users), int(rows_per_event))
+    with conn.cursor() as cur:
+        s = sample_user(cur)
+        cases = [
+            ("substring 'swiggy'", "swiggy", {}),
+            ("typo 'swigy'", "swigy", {}),
+            ("item 'grocer'", "grocer", {}),
+            ("'uber' last 30 days", "uber", {"date_from": date.today() - timedelta(days=30)}),
+            ("'amazon' >= 1000", "amazon", {"min_amount": 1000}),
+        ]
+        timings = {}
+        for indexed in (True, False):
+            if not indexed:
+                cur.execute("DROP INDEX idx_transactions_merchant_trgm, idx_transactions_item_trgm")
+            for name, text, filters in cases:
+                sql, params = search_sql(s["user_id"], text, **filters)
+                plan, _ = explain(cur, sql, params)
+                timings.setdefault(name, []).append((median_ms(cur, sql, params), ", ".join(parent_indexes(cur, index_names(plan)))))
+        conn.rollback()
+
+        logging.info(f"{'query':<22}{'trigram (ms)':>14}{'without (ms)':>14}   indexes used with / without")
+        for name, ((with_ms, with_indexes), (without_ms, without_indexes)) in timings.items():
+            logging.info(f"{name:<22}{with_ms:>14.3f}{without_ms:>14.3f}   {with_indexes} / {without_indexes}")
+
+        limit, after, seen, page_ms = int(page_size), None, [], []
+        while True:
+            start = time.perf_counter()
+            rows = run_sync(search_transactions(SyncCursor(conn, cur), s["user_id"], "swiggy", limit + 1, after))
+            page_ms.append((time.perf_counter() - start) * 1000)
+            seen += [row[0] for row in rows[:limit]]
+            if len(rows) <= limit:
+                break
+            after = search_key(rows[limit - 1])
+        total = len(run_sync(search_transactions(SyncCursor(conn, cur), s["user_id"], "swiggy", 10 ** 6)))
+        logging.info(f"keyset pages of {limit} for 'swiggy': {len(page_ms)} pages, {len(seen)}/{total} rows, "
+                     f"first {page_ms[0]:.2f} ms, last {page_ms[-1]:.2f} ms")
+    conn.rollback()
+    conn.close()
+    if len(seen) != total or len(set(seen)) != len(seen):
+        sys.exit("Keyset pages skipped or repeated rows")
+
+
+def bench_event_totals(users="200", rows_per_event="2000", adds="500"):
+    """
+    list and the show event total read off the events row against summing the event's transactions,
+    and what keeping the totals costs each add; fails if the kept totals drift from a recount.
+    """
+    from commands import SyncCursor, run_sync, handle_incoming_message
+
+    conn = get_bench_conn()
+    seed_database(conn, int(users), int(rows_per_event))
+    with conn.cursor() as cur:
+        s = sample_user(cur)
+        cases = [
+            ("list", """
+                SELECT e.event_name, COALESCE(SUM(t.amount) FILTER (WHERE upper(t.action) IS DISTINCT FROM 'CREDIT'), 0),
+                       count(t.tran_id), max(t.created_at)
+                FROM events e LEFT JOIN transactions t ON t.event_id = e.event_id AND t.user_id = e.user_id
+                WHERE e.user_id = %s GROUP BY e.event_id, e.event_name
+             """, "SELECT event_name, event_id, total_spent, item_count, last_activity_at FROM events WHERE user_id = %s",
+             (s["user_id"],)),
+            ("show event total", """
+                SELECT COALESCE(SUM(amount) FILTER (WHERE upper(action) IS DISTINCT FROM 'CREDIT'), 0), count(*)
+                FROM transactions WHERE event_id = %s AND user_id = %s
+             """, "SELECT total_spent, item_count FROM events WHERE event_id = %s AND user_id = %s",
+             (s["event_id"], s["user_id"])),
+        ]
+        logging.info(f"{'query':<20}{'summed (ms)':>14}{'kept (ms)':>12}")
+        for name, summed_sql, kept_sql, params in cases:
+            logging.info(f"{name:<20}{median_ms(cur, summed_sql, params):>14.3f}{median_ms(cur, kept_sql, params):>12.3f}")
+
+        plain_sql = "INSERT INTO transactions (event_id, date, action, item, amount, user_id) VALUES (%s, %s, %s, %s, %s, %s)"
+        cursor = SyncCursor(conn, cur)
+        cur.execute("SAVEPOINT plain_inserts")
+        timings = {}
+        for name in ("plain insert", "add + totals"):
+            start = time.perf_counter()
+            for i in range(int(adds)):
+                if name == "plain insert":
+                    cur.execute(plain_sql, (s["event_id"], date.today(), "DEBIT", "tea", 10 + i % 90, s["user_id"]))
+                else:
+                    run_sync(handle_incoming_message(cursor, s["phone_number"], f"add tea {10 + i % 90}"))
+            timings[name] = (time.perf_counter() - start) / int(adds) * 1000
+            if name == "plain insert":
+                # These skipped the totals on purpose; keep them out of the drift check
+                cur.execute("ROLLBACK TO SAVEPOINT plain_inserts")
+        logging.info(f"plain insert {timings['plain insert']:.3f} ms/add, "
+                     f"add command with totals {timings['add + totals']:.3f} ms/add (includes the command's other queries)")
+
+        cur.execute("""
+            SELECT count(*) FROM events e JOIN LATERAL (
+                SELECT COALESCE(SUM(amount) FILTER (WHERE upper(action) IS DISTINCT FROM 'CREDIT'), 0) AS spent, count(*) AS items
+                FROM transactions WHERE event_id = e.event_id
+            ) t ON true
+            WHERE e.total_spent <> t.spent OR e.item_count <> t.items
+        """)
+        drifted = cur.fetchone()[0]
+    conn.rollback()
+    conn.close()
+    if drifted:
+        sys.exit(f"{drifted} events have running totals that differ from their transactions")
+
+
+def bench_reader_leases(workers="1,8", users="2000", work_ms="5"):
+    """
+    email_reader workers leasing users through reader_jobs: throughput by worker count, and fails
+    on any user leased twice, never leased, left stranded by a crashed worker, handed out with
+    another user's id, or leased without an active pattern.
+    """
+    import threading
+    from migrations import get_conn
+    from commands import SyncCursor, run_sync, lease_reader_jobs, complete_reader_job
+
+    conn = get_bench_conn()
+    seed_database(conn, int(users), 1, 30)
+    url = os.getenv("BENCHMARK_DATABASE_URL")
+    with conn.cursor() as cur:
+        # Seeded config ids start above every user id, so a config id never equals its user id
+        cur.execute("SELECT id, user_id FROM user_email_configs")
+        owners = dict(cur.fetchall())
+    assert all(config_id != user_id for config_id, user_id in owners.items())
+
+    def work(worker_id, leased, wrong_owner):
+        wconn = get_conn(url)
+        while True:
+            with wconn:
+                with wconn.cursor() as cur:
+                    jobs = run_sync(lease_reader_jobs(SyncCursor(wconn, cur), worker_id))
+            if not jobs:
+                break
+            time.sleep(int(work_ms) / 1000)  # Gmail round trips
+            for job in jobs:
+                leased.append(job["email_config_id"])
+                wrong_owner.extend([job["email_config_id"]] if job["user_id"] != owners[job["email_config_id"]] else [])
+                with wconn:
+                    with wconn.cursor() as cur:
+                        run_sync(complete_reader_job(SyncCursor(wconn, cur), job["email_config_id"], job["lease_token"]))
+        wconn.close()
+
+    failed = False
+    for count in [int(n) for n in workers.split(",")]:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE reader_jobs SET next_run_at = now(), lease_token = NULL, leased_by = NULL,
+                                           lease_expires_at = NULL, attempts = 0
+                """)
+                # Only configs with an active pattern are ever leased
+                cur.execute("""
+                    SELECT email_config_id FROM reader_jobs j WHERE EXISTS (
+                        SELECT 1 FROM user_email_patterns uep WHERE uep.user_email_config_id = j.email_config_id AND uep.active)
+                """)
+                leasable = {row[0] for row in cur.fetchall()}
+                # A worker that crashes right after leasing 20 users for a second.
+                crashed = {job["email_config_id"] for job in
+                           run_sync(lease_reader_jobs(SyncCursor(conn, cur), "crashed", 20, 1))}
+        time.sleep(1.1)
+
+        leased, wrong_owner = [], []
+        threads = [threading.Thread(target=work, args=(f"bench-{n}", leased, wrong_owner)) for n in range(count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        doubled, missing = len(leased) - len(set(leased)), len(leasable - set(leased))
+        reclaimed = len(crashed & set(leased))
+        without_patterns = len(set(leased) - leasable)
+        logging.info(f"{count:>3} worker(s): {len(leased)} users in {elapsed:.2f}s ({len(leased) / elapsed:.0f}/s), "
+                     f"leased twice {doubled}, never leased {missing}, crashed leases reclaimed {reclaimed}/{len(crashed)}, "
+                     f"wrong user {len(wrong_owner)}, without active patterns {without_patterns}")
+        failed = failed or doubled or missing or reclaimed < len(crashed) or wrong_owner or without_patterns
+    conn.close()
+    if failed:
+        sys.exit(1)
+
+
+# ---------- Email prefilter ----------
+ALERT_PATTERNS = [
+    ("UPI_DEBIT", r"Rs\.(?P<amount>[0-9,.]+) has been debited from account \*\*(?P<account>\d+) to VPA "
+                  r"(?P<merchant>[^ ]+) .*? on (?P<date>\d{2}-\d{2}-\d{2})\. Your UPI transaction reference "
+                  r"number is (?P<ref>\d+)"),
+    ("UPI_CREDIT", r"Rs\.(?P<amount>[0-9,.]+) is successfully credited to your account \*\*(?P<account>\d+) by VPA "
+                   r"(?P<merchant>[^ ]+) .*? on (?P<date>\d{2}-\d{2}-\d{2})\. Your UPI transaction reference "
+                   r"number is (?P<ref>\d+)"),
+]
+
+
+def fake_mailbox(count, alert_share, seed=42):
+    """(snippet, sizeEstimate, plain text body) of HDFC-like mails: small alerts among large statements and offers."""
+    rng = random.Random(seed)
+    other = [
+        "Your HDFC Bank Credit Card statement for {month} is ready. Total amount due Rs.{amount}. Minimum amount due",
+        "Exclusive offer for you! Get up to {pct}% cashback on {merchant} with your HDFC Bank Debit Card. T&C apply",
+        "{otp} is your OTP for the transaction of Rs.{amount} at {merchant}. Do not share it with anyone.",
+        "Dear Customer, your account **{account} has been debited for Rs.{amount} towards the EMI of your loan",
+    ]
+    for _ in range(count):
+        fields = {"amount": f"{rng.uniform(10, 20000):,.2f}", "account": rng.randrange(1000, 9999),
+                  "merchant": rng.choice(MERCHANTS), "ref": rng.randrange(10 ** 11, 10 ** 12),
+                  "date": (date.today() - timedelta(days=rng.randrange(30))).strftime("%d-%m-%y"),
+                  "month": rng.choice(["Sep-26", "Oct-26"]), "pct": rng.choice([5, 10, 20]), "otp": rng.randrange(10 ** 5, 10 ** 6)}
+        if rng.random() < alert_share:
+            verb = rng.choice(["has been debited from account **{account} to", "is successfully credited to your account **{account} by"])
+            # Some banks open with a greeting long enough to push the whole match past the snippet
+            preamble = ("Greetings from HDFC Bank! We are writing to keep you informed about recent activity on your "
+                        "savings account. Please read the details below carefully and keep this email for your "
+                        "records. This is a system generated alert. ") if rng.random() < 0.3 else ""
+            body = (preamble + "Dear Customer, Rs.{amount} " + verb + " VPA {merchant_vpa} {merchant} on {date}. Your UPI transaction "
+                    "reference number is {ref}. If you did not authorize this transaction, please report it immediately "
+                    "by calling 18002586161.").format(merchant_vpa=fields["merchant"].lower().replace(" ", "") + "@upi", **fields)
+            size = rng.randrange(3000, 8000)
+        else:
+            body = rng.choice(other).format(**fields) + " " + "Terms and conditions apply. " * rng.randrange(5, 40)
+            size = rng.randrange(20000, 400000)  # HTML, inline images and attached PDFs
+        yield body[:200], size, body
+
+
+def bench_email_prefilter(messages="2000", alert_share="0.3"):
+    """Messages skipped and bytes saved by the snippet prefilter of email_reader.py; fails on any missed match."""
+    from email_reader import (pattern_anchors, is_candidate, parse_transaction_details, response_bytes,
+                              SNIPPET_TRUNCATED_AT, SNIPPET_COMPLETE_ENDINGS)
+
+    patterns = [{"type": t, "pattern_text": r} for t, r in ALERT_PATTERNS]
+    anchor_lists = [pattern_anchors(p["pattern_text"]) for p in patterns]
+    full_bytes = prefilter_bytes = skipped = matched = missed = late_matches = 0
+    for snippet, size, body in fake_mailbox(int(messages), float(alert_share)):
+        meta = {"id": "18c0ffee", "threadId": "18c0ffee", "labelIds": ["INBOX", "CATEGORY_UPDATES"], "snippet": snippet,
+                "sizeEstimate": size, "payload": {"headers": [{"name": "Subject", "value": "Alert : Update on your HDFC Bank account"}]}}
+        is_match = any(parse_transaction_details(body, p["pattern_text"], p["type"]) for p in patterns)
+        matched += is_match
+        starts = [m.start() for m in (re.search(p["pattern_text"], body) for p in patterns) if m]
+        late_matches += bool(starts) and min(starts) >= len(snippet)
+        full_bytes += size
+        prefilter_bytes += response_bytes(meta)
+        if is_candidate(meta, anchor_lists):
+            prefilter_bytes += size
+        else:
+            skipped += 1
+            missed += is_match
+
+    # Gmail also cuts snippets short of SNIPPET_TRUNCATED_AT at word boundaries, leaving later anchors
+    # past the cut. Try every such cut of matching alerts, with the real size and with none reported.
+    cuts = cut_missed = 0
+    for _, size, body in fake_mailbox(200, 1.0, seed=7):
+        if not any(parse_transaction_details(body, p["pattern_text"], p["type"]) for p in patterns):
+            continue
+        for cut in [m.start() for m in re.finditer(" ", body[:SNIPPET_TRUNCATED_AT])]:
+            for size_estimate in (size, 0):
+                if not size_estimate and body[:cut].endswith(SNIPPET_COMPLETE_ENDINGS):
+                    continue  # a finished sentence and no size: indistinguishable from a whole body
+                meta = {"snippet": body[:cut], "sizeEstimate": size_estimate, "payload": {"headers": []}}
+                cuts += 1
+                cut_missed += not is_candidate(meta, anchor_lists)
+
+    logging.info(f"{messages} messages, {matched} matching a pattern ({late_matches} starting past the snippet), "
+                 f"{skipped} skipped by snippet")
+    logging.info(f"full fetch only    {full_bytes / 1024:>12.1f} KiB")
+    logging.info(f"snippet prefilter  {prefilter_bytes / 1024:>12.1f} KiB  ({1 - prefilter_bytes / full_bytes:.0%} less)")
+    logging.info(f"short word-boundary snippets of matching alerts: {cuts - cut_missed}/{cuts} kept")
+    if missed or cut_missed:
+        logging.error(f"{missed} matching message(s) and {cut_missed} short snippet(s) of matching messages were skipped")
+        sys.exit(1)
+
+
+class _ScriptedCursor(_RecordingCursor):
+    """A _RecordingCursor answering each statement with the rows of the first (sql fragment, rows) it contains."""
+    def __init__(self, answers):
+        super().__init__()
+        self.answers = answers
+
+    async def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+        self.rows = next((list(rows) for fragment, rows in self.answers if fragment in sql), [])
+
+
+def bench_query_budgets():
+    """
+    Statements each webhook command and API route issues against index.QUERY_BUDGETS, without a
+    database: the shared coroutines run on a scripted cursor that takes the branch doing the most work.
+    """
+    import uuid
+    import index
+    import commands
+    import reply_cache
+
+    today = date.today()
+    pending = [(11, "SWIGGY", 120.0, today), (12, "ZOMATO", 80.0, today)]
+    found = [(n, today, "DEBIT", 10.0, "SWIGGY", "food", "daily", 0.9) for n in range(60)]
+
+    def answers(**settings):
+        settings = {"current_event_id": 1, "cache_generation": 3, **settings}
+        return [
+            ("INSERT INTO webhook_messages (message_sid)", [("SMbudget",)]),
+            ("SELECT tran_id, item FROM added", [(100, None)]),
+            ("FROM users WHERE phone_number", [(1,)]),
+            ("FROM users WHERE id", [(1, "budget", "+910000000001")]),
+            ("SELECT key, value FROM user_settings", [(k, json.dumps(v)) for k, v in settings.items()]),
+            ("SELECT event_id FROM events WHERE event_name", [(2,)]),
+            ("FROM events WHERE user_id", [("daily", 1, 10.0, 1, None)]),
+            ("item IS NULL", pending),
+            ("SELECT tran_id FROM tagged", [(11,), (12,)]),
+            ("word_similarity", found),
+            ("JOIN LATERAL", [("daily", 10.0, 1, "tea", 10.0)]),
+            ("SELECT date, SUM(amount)", [(today, 10.0)]),
+            ("SUM(amount)", [(10.0,)]),
+            ("COUNT(*)", [(0,)]),
+        ]
+
+    adding = {"pending_add": True, "add_buffer": [["tea", 10.0]]}
+    webhook = [
+        ("create goa", {}), ("list", {}), ("switch goa", {}), ("add tea 10", {}), ("add", {}),
+        ("coffee 20", adding), ("done", adding), ("show pending", {}),
+        ("tag 1-2 food", {"pending_txn_map": {"1": [11, today.isoformat()], "2": [12, today.isoformat()]}}),
+        ("show", {}), (f"show date {today}", {}), ("find swiggy", {}),
+        ("find more", {commands.FIND_CURSOR_KEY: {"q": "swiggy", "after": [0.9, today.isoformat(), 1]}}),
+        ("summary", {}), (f"summary date {today}", {}), (f"summary month {today:%Y-%m}", {}), ("help", {}),
+    ]
+    staged = {"user_id": 1, "transaction_date": today, "amount": 120, "action": "DEBIT", "merchant": "Swiggy"}
+    api = {
+        "/api/users/<int:user_id>/transactions": [
+            lambda c: commands.user_transactions(c, 1, None, 1, 100),
+            lambda c: commands.user_transactions(c, 1, today.isoformat(), 1, 100)],
+        "/api/users/<int:user_id>/transactions/search": [
+            lambda c: commands.transaction_search(c, 1, {"q": "swiggy", "from": "2025-01-01", "min_amount": "5"})],
+        "/api/users/<user_id>/notify-whatsapp": [lambda c: commands.get_user_by_user_id(1, c)],
+        "/api/email-configs": [lambda c: commands.email_configs(c)],
+        "/api/staged-transactions": [lambda c: commands.add_staged_transaction(c, staged)],
+        "/api/users/<int:user_id>/email-configs/<int:email_config_id>": [
+            lambda c: commands.update_email_config_fetch_info(c, 1, 1, "m1", datetime.now(), str(uuid.uuid4()))],
+        "/api/reader-jobs/lease": [lambda c: commands.lease_reader_jobs(c, "budget", 5)],
+        "/api/reader-jobs/<int:email_config_id>/heartbeat": [
+            lambda c: commands.heartbeat_reader_job(c, 1, str(uuid.uuid4()))],
+        "/api/reader-jobs/<int:email_config_id>/complete": [
+            lambda c: commands.complete_reader_job(c, 1, str(uuid.uuid4()), "boom")],
+        "/metrics": [],  # no queries
+    }
+
+    runs = []
+    for message, settings in webhook:
+        # A fresh cache generation each time, so read commands miss the in-process reply cache
+        cursor = _ScriptedCursor(answers(**settings, cache_generation=time.time_ns()))
+        commands.run_sync(commands.webhook_reply(cursor, "+910000000001", message, "SMbudget"))
+        runs.append(("/", message, len(cursor.statements)))
+    for route, calls in api.items():
+        for call in calls:
+            cursor = _ScriptedCursor(answers())
+            commands.run_sync(call(cursor))
+            runs.append((route, "", len(cursor.statements)))
+
+    logging.info(f"reply cache shared: {reply_cache.REPLY_CACHE_SHARED}")
+    logging.info(f"{'route':<62}{'case':<24}{'queries':>8}{'budget':>8}")
+    over = []
+    for route, case, count in runs:
+        budget = index.QUERY_BUDGETS[route]
+        logging.info(f"{route:<62}{case:<24}{count:>8}{budget:>8}{'  OVER' if count > budget else ''}")
+        if count > budget:
+            over.append(f"{route} {case}".strip())
+    uncovered = set(index.QUERY_BUDGETS) - {"/", *api}
+    if over or uncovered:
+        logging.error(f"over budget: {over}; routes without a budget check: {sorted(uncovered)}")
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    "report_formats": bench_report_formats,
+    "query_plans": bench_query_plans,
+    "date_filters": bench_date_filters,
+    "partitions": bench_partitions,
+    "merchant_rules": bench_merchant_rules,
+    "reader_leases": bench_reader_leases,
+    "search": bench_search,
+    "event_totals": bench_event_totals,
+    "email_prefilter": bench_email_prefilter,
+    "query_budgets": bench_query_budgets,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        for name, fn in BENCHMARKS.items():
+            print(f"{name:<20}{fn.__doc__}")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,944 @@
+"""
+WhatsApp command and API logic shared by the Flask app (index.py) and the ASGI app (asgi.py).
+
+Everything that talks to the database is a coroutine taking a cursor `c` with awaitable
+execute / fetchone / fetchall and rollback. asgi.py passes a psycopg 3 async cursor; index.py
+wraps its psycopg2 cursor in SyncCursor and drives the coroutine with run_sync. SyncCursor
+never suspends, so run_sync finishes the coroutine in a single step without an event loop.
+"""
+import os
+import json
+import base64
+import logging
+import urllib.parse
+from datetime import datetime, date, timedelta
+from twilio.twiml.messaging_response import MessagingResponse
+from metrics import WEBHOOK_COMMANDS, RENDER_LATENCY
+from reply_cache import cache_key, get_reply, put_reply
+
+# Twilio retries a delivery for minutes at most; keep MessageSids a day.
+WEBHOOK_DEDUP_TTL_SECONDS = int(os.getenv("WEBHOOK_DEDUP_TTL_SECONDS", 24 * 3600))
+
+WEBHOOK_COMMAND_NAMES = {"create", "list", "switch", "add", "done", "show", "tag", "summary", "find"}
+STAGED_REQUIRED_FIELDS = ["user_id", "transaction_date", "amount", "action"]
+CACHE_GENERATION_KEY = "cache_generation"
+# Longest range accepted in `tag 1-N`
+MAX_TAG_RANGE = 500
+# Search: trigrams need 3 characters before the index can narrow anything down.
+MIN_SEARCH_LENGTH = 3
+FIND_PAGE_SIZE = 10
+MAX_SEARCH_LIMIT = 200
+FIND_CURSOR_KEY = "find_cursor"
+UNIQUE_VIOLATION = "23505"
+# email_reader job leases. The interval sits a little under the 3-hourly workflow so each run finds its users due.
+READER_LEASE_SECONDS = int(os.getenv("READER_LEASE_SECONDS", 300))
+READER_JOB_INTERVAL_SECONDS = int(os.getenv("READER_JOB_INTERVAL_SECONDS", 2 * 3600 + 45 * 60))
+READER_JOB_RETRY_SECONDS = int(os.getenv("READER_JOB_RETRY_SECONDS", 15 * 60))
+MAX_READER_LEASE_BATCH = 50
+
+
+class SyncCursor:
+    """Awaitable facade over a psycopg2 connection and cursor for run_sync."""
+    def __init__(self, conn, cur):
+        self.conn = conn
+        self.cur = cur
+
+    async def execute(self, sql, params=None):
+        self.cur.execute(sql, params)
+
+    async def fetchone(self):
+        return self.cur.fetchone()
+
+    async def fetchall(self):
+        return self.cur.fetchall()
+
+    async def rollback(self):
+        self.conn.rollback()
+
+
+def run_sync(coro):
+    """Runs a command coroutine over a SyncCursor to completion and returns its result."""
+    try:
+        coro.send(None)
+    except StopIteration as done:
+        return done.value
+    coro.close()
+    raise RuntimeError("Command awaited an asynchronous operation; run it from asgi.py instead.")
+
+
+def sqlstate(error):
+    # psycopg2 calls it pgcode, psycopg 3 sqlstate
+    return getattr(error, "pgcode", None) or getattr(error, "sqlstate", None)
+
+
+async def execute_values(c, sql, rows):
+    """Multi-row INSERT in one statement: expands the single `VALUES %s` in sql for rows."""
+    row_sql = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    await c.execute(sql.replace("%s", ", ".join([row_sql] * len(rows)), 1),
+                    [value for row in rows for value in row])
+
+
+def event_totals_sql(cte):
+    """
+    UPDATE folding the rows of data-modifying CTE cte (event_id, amount, action) into the running
+    totals of their events, for the statement that inserts them. Credits are not spending.
+    """
+    return f"""
+        UPDATE events e SET
+            total_spent = e.total_spent + d.spent,
+            item_count = e.item_count + d.items,
+            last_activity_at = now()
+        FROM (
+            SELECT event_id, COALESCE(SUM(amount) FILTER (WHERE upper(action) IS DISTINCT FROM 'CREDIT'), 0) AS spent,
+                   count(*) AS items
+            FROM {cte} WHERE event_id IS NOT NULL GROUP BY event_id
+        ) d
+        WHERE e.event_id = d.event_id
+    """
+
+
+# Date filters are half-open ranges [start, end) so they stay sargable on the DATE column.
+def day_range(day):
+    return day, day + timedelta(days=1)
+
+def month_range(month):
+    start = datetime.strptime(month, "%Y-%m").date()
+    end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start, end
+
+
+# ---------- WhatsApp webhook ----------
+def parse_webhook(body_str):
+    """Returns (incoming_msg, phone_number, message_sid) from a Twilio form body."""
+    data = urllib.parse.parse_qs(body_str)
+    incoming_msg = data.get('Body', [''])[0].strip().lower()
+    phone_number = data.get('From', [''])[0]
+    phone_number = phone_number.replace('whatsapp:', '')
+    message_sid = data.get('MessageSid', [''])[0]
+
+    logging.info(f"Received message from {phone_number}: {incoming_msg}")
+    command = incoming_msg.split(" ", 1)[0]
+    WEBHOOK_COMMANDS.inc(command if command in WEBHOOK_COMMAND_NAMES else "other")
+    return incoming_msg, phone_number, message_sid
+
+def error_reply():
+    resp = MessagingResponse()
+    resp.message("❌ Something went wrong. Please try again later.")
+    return str(resp)
+
+async def webhook_reply(c, phone_number, incoming_msg, message_sid):
+    """Handles one webhook delivery, replaying the stored reply for Twilio retries."""
+    if message_sid:
+        cached_reply = await claim_webhook_message(c, message_sid)
+        if cached_reply is not None:
+            logging.info(f"Duplicate delivery of {message_sid}. Replaying the stored reply.")
+            return cached_reply
+
+    reply = await handle_incoming_message(c, phone_number, incoming_msg)
+
+    if message_sid:
+        await store_webhook_reply(c, message_sid, reply)
+    return reply
+
+
+async def handle_incoming_message(c, phone_number, incoming_msg):
+    """Runs one WhatsApp command inside the caller's transaction and returns the TwiML reply."""
+    resp = MessagingResponse()
+    msg = resp.message()
+
+    user_info = await get_user_by_phonenumber(phone_number, c)
+    if not user_info:
+        msg.body("❌ User not found. Please contact administrator.")
+        return str(resp)
+
+    user_id = user_info['user_id']
+
+    user_settings = await get_user_settings(c, user_id)
+    current_event_id = user_settings.get("current_event_id")
+    pending_add = user_settings.get("pending_add", False)
+    add_buffer = user_settings.get("add_buffer", [])
+
+    # Read-only replies are cached per cache generation, which every write below bumps.
+    reply_key = None
+    if is_cacheable_command(incoming_msg, pending_add):
+        reply_key = cache_key(user_id, user_settings.get(CACHE_GENERATION_KEY, 0), current_event_id, incoming_msg, date.today())
+        cached_reply = await get_reply(c, reply_key)
+        if cached_reply is not None:
+            return cached_reply
+
+    if incoming_msg.startswith("create "):
+        event_name = incoming_msg.split("create ", 1)[1].strip()
+        try:
+            await c.execute("INSERT INTO events (event_name, user_id) VALUES (%s, %s)", (event_name, user_id,))
+            await bump_cache_generation(c, user_id)
+            msg.body(f"✅ Event '{event_name}' created.")
+        except Exception as e:
+            if sqlstate(e) == UNIQUE_VIOLATION:
+                await c.rollback()
+                msg.body(f"⚠️ Event '{event_name}' already exists.")
+            else:
+                logging.exception("Error creating event")
+                msg.body("❌ Failed to create event. Please try again.")
+
+    elif incoming_msg == "list":
+        # Running totals kept on the event row, so this never touches transactions
+        await c.execute("SELECT event_name, event_id, total_spent, item_count, last_activity_at FROM events WHERE user_id = %s",
+                        (user_id,))
+        rows = await c.fetchall()
+        if rows:
+            event_list = "\n".join([f"🔹 {row[0]}{' 👈' if row[1] == current_event_id else ''} – ₹{row[2]} · {row[3]} item(s)"
+                                    + (f" · last {row[4]:%Y-%m-%d}" if row[4] else "") for row in rows])
+            msg.body(f"📋 Your Events:\n{event_list}")
+        else:
+            msg.body("⚠️ No events found. Create one using `create <event_name>`.")
+
+    elif incoming_msg.startswith("switch "):
+        event_name = incoming_msg.split("switch ", 1)[1].strip()
+        await c.execute("SELECT event_id FROM events WHERE event_name = %s AND user_id = %s", (event_name, user_id,))
+        row = await c.fetchone()
+        if row:
+            current_event_id = row[0]
+            await set_user_setting(c, user_id, "current_event_id", current_event_id)
+            msg.body(f"🔄 Switched to event: {event_name}")
+        else:
+            msg.body("⚠️ Event not found. Please create it first.")
+
+    elif incoming_msg.startswith("add"):
+        parts = incoming_msg.split()
+        if not current_event_id:
+            msg.body("⚠️ Please switch to an event first using `switch <event_name>`")
+        elif len(parts) == 1:
+            await set_multiple_settings(c, user_id, {"pending_add": True, "add_buffer": []})
+            msg.body("📝 Add mode started. Send item and amount like:\n`tea 10`\nWhen done, type `done`.")
+        elif len(parts) >= 3:
+            item = parts[1]
+            try:
+                amount = float(parts[2])
+                show_date = date.today()
+                await c.execute(f"""
+                    WITH added AS (
+                        INSERT INTO transactions (event_id, date, action, item, amount, user_id) VALUES (%s, %s, %s, %s, %s, %s)
+                        RETURNING event_id, amount, action
+                    )
+                    {event_totals_sql("added")}
+                """, (current_event_id, show_date, 'DEBIT', item, amount, user_id))
+                await bump_cache_generation(c, user_id)
+                msg.body(f"💸 Added: {item} - ₹{amount}")
+            except Exception as e:
+                logging.exception(f"Failed to add transaction {e}")
+                msg.body("❌ Amount should be a number. Try again.")
+        else:
+            msg.body("❌ Usage: add <item> <amount>")
+
+    elif pending_add:
+        if incoming_msg == "done":
+            if not add_buffer:
+                msg.body("⚠️ No entries added.")
+            else:
+                show_date = date.today()
+                try:
+                    await execute_values(c, f"""
+                        WITH added AS (
+                            INSERT INTO transactions (event_id, date, action, item, amount, user_id) VALUES %s
+                            RETURNING event_id, amount, action
+                        )
+                        {event_totals_sql("added")}
+                    """, [(current_event_id, show_date, 'add', item, amount, user_id) for item, amount in add_buffer])
+                    msg.body(f"✅ {len(add_buffer)} items added.\n🛑 Exiting add mode.")
+                except Exception:
+                    logging.exception("Error inserting buffered transactions")
+                    msg.body("❌ Failed to save items. Try again later.")
+            await set_multiple_settings(c, user_id, {"pending_add": False, "add_buffer": []}, bump_cache=bool(add_buffer))
+        else:
+            parts = incoming_msg.split()
+            if len(parts) != 2:
+                msg.body("❌ Format should be: `item amount`\nOr type `done` to finish.")
+            else:
+                item = parts[0]
+                try:
+                    amount = float(parts[1])
+                    add_buffer.append((item, amount))
+                    await set_user_setting(c, user_id, "add_buffer", add_buffer)
+                    msg.body(f"➕ Staged: {item} ₹{amount}")
+                except Exception:
+                    logging.exception("Failed to parse buffer item")
+                    msg.body("❌ Amount should be a number. Try again.")
+
+    elif incoming_msg == "show pending":
+        # Show staged transactions (pending ones) for the user
+        # No date bound: untagged rows of any age are pending, and the partial pending index keeps this cheap
+        await c.execute("SELECT tran_id, merchant, amount, date FROM transactions WHERE user_id = %s AND event_id = %s AND item IS NULL",
+                        (user_id, current_event_id))
+        rows = await c.fetchall()
+        if rows:
+            # Store the transaction IDs and map them to numbers
+            # We'll create a mapping of the transaction number to the actual txn_id
+            txn_map = {}
+            pending_list = "\n".join([f"{idx+1}. ₹{row[2]} on {row[3]} at {row[1]} [TXN#{row[0]}]"
+                                     for idx, row in enumerate(rows)])
+            for idx, row in enumerate(rows):
+                txn_map[idx + 1] = [row[0], row[3].isoformat()]  # Map number to txn_id and its partition's date
+
+            # Save the mapping in the  database to use later
+            await set_user_setting(c, user_id, 'pending_txn_map', json.dumps(txn_map))
+
+            msg.body(f"📋 Pending Transactions:\n{pending_list}\n\nReply with:\ntag <numbers> <category>\nExample: tag 2 groceries or tag 1,3-5 food")
+        else:
+            msg.body("⚠️ No pending transactions found.")
+
+    elif incoming_msg.startswith("tag"):
+        parts = incoming_msg.split()
+        if len(parts) == 3:
+            try:
+                txn_numbers = parse_txn_numbers(parts[1])  # `2` or a list like `1,3-5`
+                category = parts[2]  # Get the category
+
+                # The txn_map saved by `show pending` was loaded with the rest of the settings
+                txn_map = user_settings.get('pending_txn_map') or {}
+                if isinstance(txn_map, str):
+                    txn_map = json.loads(txn_map)
+
+                numbered = {str(n): txn_map[str(n)] for n in txn_numbers if str(n) in txn_map}
+                missing = [str(n) for n in txn_numbers if str(n) not in txn_map]
+
+                if not numbered:
+                    msg.body("⚠️ Transaction not found. Please check the number and try again.")
+                elif not all(isinstance(entry, list) for entry in numbered.values()):
+                    # Saved before the map carried dates
+                    msg.body("⚠️ Your pending list has expired. Send `show pending` and tag again.")
+                else:
+                    tagged = await tag_transactions(c, user_id, list(numbered.values()), category)
+                    if not tagged:
+                        # Every row is gone or no longer the user's, so nothing changed
+                        msg.body("⚠️ Transaction not found. Please check the number and try again.")
+                    else:
+                        await bump_cache_generation(c, user_id)
+                        missing = sorted(missing + [n for n, entry in numbered.items() if entry[0] not in tagged], key=int)
+                        if len(tagged) == 1:
+                            reply = f"Tagged TXN#{tagged[0]} with item '{category}' ✅"
+                        else:
+                            reply = f"Tagged {len(tagged)} transactions with item '{category}' ✅"
+                        if missing:
+                            reply += f"\n⚠️ Not found: {', '.join(missing)}"
+                        msg.body(reply)
+            except ValueError:
+                msg.body("❌ Invalid input. Please use the format: tag <numbers> <category>\nExample: tag 1,3-5 groceries")
+
+        else:
+            msg.body("❌ Invalid format. Please use the format: tag <numbers> <category>\nExample: tag 1,3-5 groceries")
+
+    elif incoming_msg.startswith("show"):
+        if not current_event_id:
+            msg.body("⚠️ Please switch to an event first using `switch <event_name>`")
+        else:
+            parts = incoming_msg.split()
+            try:
+                if len(parts) == 1:
+                    show_date = date.today()
+                elif len(parts) == 3 and parts[1] == "date":
+                    show_date = datetime.strptime(parts[2], '%Y-%m-%d').date()
+                else:
+                    msg.body("❌ Invalid format. Use:\n• show\n• show date YYYY-MM-DD")
+                    return str(resp)
+
+                # The event's running totals ride along with the day's rows in the same round trip
+                await c.execute("""
+                    SELECT e.event_name, e.total_spent, e.item_count, d.item, d.amount FROM events e
+                    LEFT JOIN LATERAL (
+                        SELECT item, amount FROM transactions
+                        WHERE event_id = e.event_id AND date >= %s AND date < %s and user_id = %s
+                    ) d ON true
+                    WHERE e.event_id = %s
+                """, (*day_range(show_date), user_id, current_event_id))
+                rows = await c.fetchall()
+                event_total = f"\n🧾 {rows[0][0]} total: ₹{rows[0][1]} across {rows[0][2]} item(s)" if rows else ""
+                rows = [r[3:] for r in rows if r[4] is not None]
+                if not rows:
+                    msg.body(f"ℹ️ No expenses found for {show_date}{event_total}")
+                else:
+                    total = sum([r[1] for r in rows])
+                    item_list = "\n".join([f"• {r[0]} – ₹{r[1]}" for r in rows])
+                    msg.body(f"📅 Expenses for {show_date}:\n{item_list}\n💰 Total: ₹{total}{event_total}")
+            except Exception as e:
+                logging.error(f"[ERROR] Show command failed: {e}")
+                msg.body("❌ Error fetching data. Check format or try again later.")
+
+    elif incoming_msg.startswith("find"):
+        text = incoming_msg[len("find"):].strip()
+        after = None
+        if text == "more":
+            saved = user_settings.get(FIND_CURSOR_KEY)
+            if not saved:
+                msg.body("⚠️ Nothing more to show. Start a search with `find <text>`.")
+                return str(resp)
+            text, after = saved["q"], saved["after"]
+        if len(text) < MIN_SEARCH_LENGTH:
+            msg.body(f"❌ Usage: find <text>, at least {MIN_SEARCH_LENGTH} characters\nExample: find swiggy")
+        else:
+            rows = await search_transactions(c, user_id, text, FIND_PAGE_SIZE + 1, after)
+            page, has_more = rows[:FIND_PAGE_SIZE], len(rows) > FIND_PAGE_SIZE
+            if page:
+                total = sum(row[3] for row in page)
+                lines = "\n".join([f"• ₹{row[3]} on {row[1]} at {row[4] or '-'}" + (f" – {row[5]}" if row[5] else "")
+                                   + (f" [{row[6]}]" if row[6] else "") for row in page])
+                reply = f"🔎 Results for '{text}':\n{lines}\n💰 Total: ₹{total}"
+                if has_more:
+                    reply += f"\n\nSend `find more` for the next {FIND_PAGE_SIZE}."
+                msg.body(reply)
+            else:
+                msg.body(f"ℹ️ No transactions match '{text}'." if after is None else "ℹ️ No more results.")
+            if has_more:
+                await set_user_setting(c, user_id, FIND_CURSOR_KEY, {"q": text, "after": search_key(page[-1])})
+            elif user_settings.get(FIND_CURSOR_KEY):
+                await set_user_setting(c, user_id, FIND_CURSOR_KEY, None)
+
+    elif incoming_msg.startswith("summary"):
+        if not current_event_id:
+            msg.body("⚠️ Please switch to an event first using `switch <event_name>`")
+        else:
+            parts = incoming_msg.split()
+            if len(parts) == 1:
+                today = date.today()
+                await c.execute("SELECT SUM(amount) FROM transactions WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s",
+                                (current_event_id, *day_range(today), user_id))
+                row = await c.fetchone()
+                total = row[0] if row[0] else 0
+                msg.body(f"📅 Total spent today ({today}): ₹{total}")
+            elif len(parts) == 3 and parts[1] == "date":
+                try:
+                    show_date = datetime.strptime(parts[2], '%Y-%m-%d').date()
+                except ValueError:
+                    msg.body("❌ Invalid date. Use: summary date YYYY-MM-DD")
+                    return str(resp)
+                await c.execute("SELECT SUM(amount) FROM transactions WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s",
+                                (current_event_id, *day_range(show_date), user_id))
+                row = await c.fetchone()
+                total = row[0] if row[0] else 0
+                msg.body(f"📅 Total spent on {show_date}: ₹{total}")
+            elif len(parts) == 3 and parts[1] == "month":
+                month = parts[2]
+                try:
+                    month_start, month_end = month_range(month)
+                except ValueError:
+                    msg.body("❌ Invalid month. Use: summary month YYYY-MM")
+                    return str(resp)
+                await c.execute("SELECT date, SUM(amount) FROM transactions WHERE event_id = %s AND date >= %s AND date < %s and user_id = %s GROUP BY date ORDER BY date",
+                                (current_event_id, month_start, month_end, user_id))
+                rows = await c.fetchall()
+                if rows:
+                    total = sum([row[1] for row in rows])
+                    lines = [f"{row[0]}: ₹{row[1]}" for row in rows]
+                    msg.body(f"📆 Monthly Total for {month}: ₹{total}\n\n📊 Daily Breakdown:\n" + "\n".join(lines))
+                else:
+                    msg.body(f"ℹ️ No transactions found for month {month}")
+            else:
+                msg.body("❌ Invalid summary format.\nTry:\n• summary\n• summary date YYYY-MM-DD\n• summary month YYYY-MM")
+
+    else:
+        msg.body(
+    "🤖 I didn't understand that.\n\n"
+    "Try:\n"
+    "• create <event>\n"
+    "• list\n"
+    "• switch <event>\n"
+    "• add <item> <amount>\n"
+    "• add (then items... then `done`)\n"
+    "• summary\n"
+    "• show\n"
+    "• find <text>"
+)
+
+    reply = str(resp)
+    if reply_key and "❌" not in reply:
+        await put_reply(c, reply_key, reply)
+    return reply
+
+def parse_txn_numbers(spec):
+    """`1,3-5` -> [1, 3, 4, 5]. Raises ValueError on anything else."""
+    numbers = set()
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        first, last = int(first), int(last or first)
+        if first < 1 or last < first or last - first >= MAX_TAG_RANGE:
+            raise ValueError(f"Invalid transaction numbers: {part}")
+        numbers.update(range(first, last + 1))
+    return sorted(numbers)
+
+async def tag_transactions(c, user_id, entries, category):
+    """
+    Sets item on the [tran_id, date] entries in one statement, learns a merchant rule from
+    every tagged row that has a merchant and touches the events' last activity. Returns the tagged tran_ids.
+    """
+    values = ", ".join(["(%s, %s::date)"] * len(entries))
+    await c.execute(f"""
+        WITH tagged AS (
+            UPDATE transactions t SET item = %s
+            FROM (VALUES {values}) AS v(tran_id, date)
+            WHERE t.tran_id = v.tran_id AND t.date = v.date
+              AND t.user_id = %s AND t.date = ANY(%s::date[])
+            RETURNING t.tran_id, t.event_id, merchant_key(t.merchant) AS merchant
+        ), touched AS (
+            -- Retagging moves no money, but it is activity on the event
+            UPDATE events SET last_activity_at = now() WHERE event_id IN (SELECT event_id FROM tagged)
+        ), learned AS (
+            INSERT INTO merchant_rules (user_id, merchant, item)
+            SELECT DISTINCT %s::int, merchant, %s FROM tagged WHERE merchant IS NOT NULL
+            ON CONFLICT (user_id, merchant) DO UPDATE SET
+                hits = CASE WHEN merchant_rules.item = EXCLUDED.item THEN merchant_rules.hits + 1 ELSE 1 END,
+                item = EXCLUDED.item, updated_at = now()
+        )
+        SELECT tran_id FROM tagged ORDER BY tran_id
+    """, [category, *[value for entry in entries for value in entry], user_id, [entry[1] for entry in entries],
+          user_id, category])
+    return [row[0] for row in await c.fetchall()]
+
+async def search_transactions(c, user_id, text, limit, after=None, date_from=None, date_to=None, event=None,
+                              min_amount=None, max_amount=None):
+    """
+    Transactions of user_id whose merchant or item contains text or has a word close to it,
+    best match first, then newest. Rows are (tran_id, date, action, amount, merchant, item,
+    event_name, score). after is the search_key of the last row of the previous page.
+    """
+    pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    # Each branch of the OR is served by a (user_id, column gin_trgm_ops) index.
+    query = """
+        SELECT t.tran_id, t.date, t.action, t.amount, t.merchant, t.item, e.event_name, m.score
+        FROM transactions t
+        LEFT JOIN events e ON e.event_id = t.event_id
+        CROSS JOIN LATERAL (SELECT GREATEST(word_similarity(%s, t.merchant), word_similarity(%s, t.item)) AS score) m
+        WHERE t.user_id = %s
+          AND (t.merchant ILIKE %s OR t.item ILIKE %s OR %s <%% t.merchant OR %s <%% t.item)
+    """
+    params = [text, text, user_id, pattern, pattern, text, text]
+    if date_from:
+        query += " AND t.date >= %s"
+        params.append(date_from)
+    if date_to:
+        query += " AND t.date < %s"
+        params.append(date_to)
+    if event:
+        query += " AND e.event_name = %s"
+        params.append(event)
+    if min_amount is not None:
+        query += " AND t.amount >= %s"
+        params.append(min_amount)
+    if max_amount is not None:
+        query += " AND t.amount <= %s"
+        params.append(max_amount)
+    if after:
+        # Keyset paging: resume strictly after the last row shown, in the ORDER BY below.
+        query += " AND (m.score, t.date, t.tran_id) < (%s::real, %s::date, %s)"
+        params += list(after)
+    query += " ORDER BY m.score DESC, t.date DESC, t.tran_id DESC LIMIT %s"
+    params.append(limit)
+    await c.execute(query, params)
+    return await c.fetchall()
+
+def search_key(row):
+    """[score, date, tran_id] of a search_transactions row, the `after` of the next page."""
+    return [row[7], row[1].isoformat(), row[0]]
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor):
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (isinstance(key, list) and len(key) == 3):
+        raise ValueError("Invalid cursor")
+    return [float(key[0]), datetime.strptime(key[1], "%Y-%m-%d").date(), int(key[2])]
+
+def is_cacheable_command(incoming_msg, pending_add):
+    if incoming_msg == "list":
+        return True
+    # In add mode everything except `list` is read as an item line
+    return not pending_add and incoming_msg != "show pending" and incoming_msg.startswith(("show", "summary"))
+
+
+# ---------- API ----------
+async def transaction_search(c, user_id, args):
+    """Returns (body, status) for GET /api/users/<user_id>/transactions/search; args are the query parameters."""
+    text = (args.get('q') or "").strip()
+    if len(text) < MIN_SEARCH_LENGTH:
+        return {"error": f"'q' must be at least {MIN_SEARCH_LENGTH} characters."}, 400
+    try:
+        limit = min(int(args.get('limit', 50)), MAX_SEARCH_LIMIT)
+        date_from = datetime.strptime(args['from'], "%Y-%m-%d").date() if args.get('from') else None
+        # `to` is inclusive for callers; the query takes the half-open end.
+        date_to = datetime.strptime(args['to'], "%Y-%m-%d").date() + timedelta(days=1) if args.get('to') else None
+        min_amount = float(args['min_amount']) if args.get('min_amount') else None
+        max_amount = float(args['max_amount']) if args.get('max_amount') else None
+        after = decode_cursor(args['cursor']) if args.get('cursor') else None
+    except (ValueError, TypeError):
+        return {"error": "Invalid parameters. Dates are YYYY-MM-DD, amounts and limit numbers, cursor as returned."}, 400
+    if limit < 1:
+        return {"error": "'limit' must be positive."}, 400
+
+    rows = await search_transactions(c, user_id, text, limit + 1, after, date_from, date_to, args.get('event'),
+                                     min_amount, max_amount)
+    page = rows[:limit]
+    with RENDER_LATENCY.time("/api/users/<int:user_id>/transactions/search"):
+        result = [
+            {
+                "tran_id": row[0],
+                "date": row[1].strftime("%Y-%m-%d"),
+                "action": row[2],
+                "item": row[5],
+                "amount": float(row[3]),
+                "merchant": row[4],
+                "event": row[6],
+                "score": round(float(row[7] or 0), 3)
+            } for row in page
+        ]
+    return {
+        "q": text,
+        "limit": limit,
+        "transactions": result,
+        "next_cursor": encode_cursor(search_key(page[-1])) if len(rows) > limit else None
+    }, 200
+
+async def user_transactions(c, user_id, date_filter, page, limit):
+    """Returns (body, status) for GET /api/users/<user_id>/transactions."""
+    offset = (page - 1) * limit
+    user_info = await get_user_by_user_id(user_id, c)
+    if not user_info:
+        return {"error": f"User {user_id} not found"}, 400
+
+    base_query = """
+        SELECT
+            t.date, t.action, t.amount, t.merchant, t.item, e.event_name AS event_name, t.tran_id
+        FROM transactions t
+        LEFT JOIN events e ON t.event_id = e.event_id
+        WHERE t.user_id = %s
+    """
+
+    count_query = "SELECT COUNT(*) FROM transactions t WHERE t.user_id = %s"
+    params = [user_id]
+
+    if date_filter:
+        try:
+            filter_date = datetime.strptime(date_filter, "%Y-%m-%d").date()
+        except ValueError:
+            return {"error": "Invalid date format. Use YYYY-MM-DD."}, 400
+        base_query += " AND t.date >= %s AND t.date < %s"
+        count_query += " AND t.date >= %s AND t.date < %s"
+        params += list(day_range(filter_date))
+
+    base_query += " ORDER BY t.date DESC LIMIT %s OFFSET %s"
+    params += [limit, offset]
+
+    await c.execute(base_query, params)
+    rows = await c.fetchall()
+
+    # Get total count
+    await c.execute(count_query, params[:len(params) - 2])  # Only the user_id/date
+    total_count = (await c.fetchone())[0]
+
+    with RENDER_LATENCY.time("/api/users/<int:user_id>/transactions"):
+        result = [
+            {
+                "tran_id": row[6],
+                "date": row[0].strftime("%Y-%m-%d"),
+                "action": row[1],
+                "item": row[4],
+                "amount": float(row[2]),
+                "merchant": row[3],
+                "event": row[5]
+            } for row in rows
+        ]
+    return {
+        "page": page,
+        "limit": limit,
+        "total": total_count,
+        "transactions": result
+    }, 200
+
+async def email_configs(c):
+    await c.execute("""
+        SELECT
+            u.id as user_id, u.name, u.phone_number,
+            ue.email, ue.provider, ue.token, ue.id as email_config_id,
+            ep.type, ep.pattern_text, ep.source, ue.last_fetched_email_id,last_email_fetch_time
+        FROM users u
+        JOIN user_email_configs ue ON u.id = ue.user_id
+        JOIN user_email_patterns uep ON uep.user_email_config_id = ue.id AND uep.active = TRUE
+        JOIN email_patterns ep ON ep.id = uep.email_pattern_id
+    """)
+    return group_email_configs(await c.fetchall())
+
+def group_email_configs(rows, key_column=0):
+    """One config dict per key (user_id by default) from email-config rows joined to their patterns."""
+    result_map = {}
+    for row in rows:
+        key = row[key_column]
+        if key not in result_map:
+            result_map[key] = {
+                "user_id": row[0],
+                "name": row[1],
+                "phone_number": row[2],
+                "email": row[3],
+                "provider": row[4],
+                "token": row[5],
+                "email_config_id": row[6],
+                "patterns": [],
+                "last_fetched_email_id": row[10],
+                "last_email_fetch_time": row[11],
+            }
+        if row[7] is not None:
+            result_map[key]["patterns"].append({
+                "type": row[7],
+                "pattern_text": row[8],
+                "source": row[9]
+            })
+    return list(result_map.values())
+
+async def add_staged_transaction(c, data):
+    """Returns (body, status) for POST /api/staged-transactions."""
+    created_at = datetime.now()
+    user_info = await get_user_by_user_id(data['user_id'], c)
+    if not user_info:
+        return {"error": f"User with id {data['user_id']} not found."}, 404
+    user_settings = await get_user_settings(c, user_info['user_id'])
+    current_event_id = user_settings.get("current_event_id")
+    # item comes from the user's merchant rule when there is one, so the row skips `show pending`
+    await c.execute(f"""
+        WITH added AS (
+            INSERT INTO transactions
+                (event_id, date, action, amount, user_id, created_at, merchant, transaction_ref, item)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s,
+                    (SELECT item FROM merchant_rules WHERE user_id = %s AND merchant = merchant_key(%s)))
+            RETURNING tran_id, item, event_id, amount, action
+        ), totals AS ({event_totals_sql("added")})
+        SELECT tran_id, item FROM added
+    """, (
+        current_event_id,
+        data["transaction_date"],
+        data["action"],
+        data["amount"],
+        data["user_id"],
+        created_at,
+        data.get("merchant"),
+        data.get("transaction_ref"),
+        user_info['user_id'],
+        data.get("merchant")
+    ))
+    new_tran_id, item = await c.fetchone()
+    await bump_cache_generation(c, user_info['user_id'])
+    return {"tran_id": new_tran_id, "item": item, "message": "Transaction added successfully"}, 201
+
+async def update_email_config_fetch_info(c, user_id, email_config_id, last_fetched_email_id, last_email_fetch_time,
+                                         lease_token=None):
+    """
+    Advances the fetch checkpoint. With lease_token, only while that reader job lease is live,
+    so a worker whose lease was reclaimed cannot move the checkpoint. Returns whether a row changed.
+    """
+    # Build dynamic update fields
+    updates = []
+    values = []
+
+    if last_fetched_email_id is not None:
+        updates.append("last_fetched_email_id = %s")
+        values.append(last_fetched_email_id)
+
+    if last_email_fetch_time is not None:
+        updates.append("last_email_fetch_time = %s")
+        values.append(last_email_fetch_time)
+
+    # Final SQL
+    values.extend([user_id, email_config_id, lease_token, lease_token])
+    set_clause = ", ".join(updates)
+
+    await c.execute(
+        f"""
+        UPDATE user_email_configs
+        SET {set_clause}
+        WHERE user_id = %s AND id = %s
+          AND (%s::uuid IS NULL OR EXISTS (
+              SELECT 1 FROM reader_jobs j
+              WHERE j.email_config_id = user_email_configs.id AND j.lease_token = %s::uuid AND j.lease_expires_at > now()))
+        RETURNING id
+        """,
+        tuple(values)
+    )
+    return await c.fetchone() is not None
+
+
+# ---------- Email Reader Jobs ----------
+async def lease_reader_jobs(c, worker_id, limit=1, lease_seconds=READER_LEASE_SECONDS):
+    """
+    Leases up to limit due reader jobs that have an active pattern to worker_id and returns their
+    email configs, each with the lease_token that heartbeats, checkpoints and completion must
+    present. SKIP LOCKED lets concurrent workers pass over each other's rows; an expired lease is
+    due again, so a crashed worker's users come back on the next lease call.
+    """
+    await c.execute("""
+        WITH due AS (
+            SELECT email_config_id FROM reader_jobs j
+            WHERE next_run_at <= now() AND (lease_expires_at IS NULL OR lease_expires_at <= now())
+              -- A config with no active pattern has nothing to search for in the user's mailbox
+              AND EXISTS (SELECT 1 FROM user_email_patterns uep
+                          WHERE uep.user_email_config_id = j.email_config_id AND uep.active)
+            ORDER BY next_run_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), leased AS (
+            UPDATE reader_jobs j
+            SET lease_token = gen_random_uuid(), leased_by = %s,
+                lease_expires_at = now() + %s * interval '1 second', attempts = j.attempts + 1
+            FROM due WHERE j.email_config_id = due.email_config_id
+            RETURNING j.email_config_id, j.lease_token, j.lease_expires_at
+        )
+        SELECT
+            u.id as user_id, u.name, u.phone_number,
+            ue.email, ue.provider, ue.token, ue.id as email_config_id,
+            ep.type, ep.pattern_text, ep.source, ue.last_fetched_email_id, ue.last_email_fetch_time,
+            l.lease_token::text, l.lease_expires_at
+        FROM leased l
+        JOIN user_email_configs ue ON ue.id = l.email_config_id
+        JOIN users u ON u.id = ue.user_id
+        LEFT JOIN user_email_patterns uep ON uep.user_email_config_id = ue.id AND uep.active = TRUE
+        LEFT JOIN email_patterns ep ON ep.id = uep.email_pattern_id
+    """, (min(int(limit), MAX_READER_LEASE_BATCH), worker_id, lease_seconds))
+    rows = await c.fetchall()
+    configs = group_email_configs(rows, key_column=6)
+    leases = {row[6]: (row[12], row[13]) for row in rows}
+    for config in configs:
+        lease_token, lease_expires_at = leases[config["email_config_id"]]
+        config["lease_token"] = lease_token
+        config["lease_expires_at"] = lease_expires_at.isoformat()
+    return configs
+
+async def heartbeat_reader_job(c, email_config_id, lease_token, lease_seconds=READER_LEASE_SECONDS):
+    """Returns (body, status): the extended lease, or 409 once the lease has expired or moved on."""
+    await c.execute("""
+        UPDATE reader_jobs SET lease_expires_at = now() + %s * interval '1 second'
+        WHERE email_config_id = %s AND lease_token = %s::uuid AND lease_expires_at > now()
+        RETURNING lease_expires_at
+    """, (lease_seconds, email_config_id, lease_token))
+    row = await c.fetchone()
+    if not row:
+        return {"error": "Lease lost"}, 409
+    return {"lease_expires_at": row[0].isoformat()}, 200
+
+async def complete_reader_job(c, email_config_id, lease_token, error=None):
+    """
+    Releases the lease and schedules the next run: a full interval after success, a retry that
+    doubles with each consecutive failed lease (capped at the interval) after an error.
+    An expired lease may still complete as long as no other worker has taken the job since.
+    """
+    await c.execute("""
+        UPDATE reader_jobs SET
+            lease_token = NULL, leased_by = NULL, lease_expires_at = NULL,
+            next_run_at = now() + CASE WHEN %s::text IS NULL THEN %s
+                                       ELSE LEAST(%s, %s * 2 ^ (attempts - 1)) END * interval '1 second',
+            attempts = CASE WHEN %s::text IS NULL THEN 0 ELSE attempts END,
+            last_error = %s::text,
+            last_completed_at = CASE WHEN %s::text IS NULL THEN now() ELSE last_completed_at END
+        WHERE email_config_id = %s AND lease_token = %s::uuid
+        RETURNING next_run_at
+    """, (error, READER_JOB_INTERVAL_SECONDS, READER_JOB_INTERVAL_SECONDS, READER_JOB_RETRY_SECONDS,
+          error, error, error, email_config_id, lease_token))
+    row = await c.fetchone()
+    if not row:
+        return {"error": "Lease lost"}, 409
+    return {"next_run_at": row[0].isoformat()}, 200
+
+
+# ---------- Webhook Deduplication ----------
+async def claim_webhook_message(c, message_sid):
+    """
+    Marks message_sid as being handled in the current transaction.
+    Returns None when this delivery should run the command, or the stored TwiML reply
+    when it is a Twilio retry. A retry that arrives while the first delivery is still
+    running waits on the primary key until that transaction commits or rolls back.
+    """
+    await c.execute("""
+        INSERT INTO webhook_messages (message_sid) VALUES (%s)
+        ON CONFLICT (message_sid) DO NOTHING
+        RETURNING message_sid
+    """, (message_sid,))
+    if await c.fetchone():
+        return None
+    await c.execute("SELECT reply FROM webhook_messages WHERE message_sid = %s", (message_sid,))
+    row = await c.fetchone()
+    return row[0] if row else None
+
+async def store_webhook_reply(c, message_sid, reply):
+    # Upsert, since a handler may have rolled back the claim. Expired ids are trimmed
+    # a few at a time in the same statement so cleanup never costs its own round trip.
+    await c.execute("""
+        WITH expired AS (
+            DELETE FROM webhook_messages WHERE message_sid IN (
+                SELECT message_sid FROM webhook_messages
+                WHERE created_at < now() - %s * interval '1 second'
+                LIMIT 20 FOR UPDATE SKIP LOCKED
+            )
+        )
+        INSERT INTO webhook_messages (message_sid, reply) VALUES (%s, %s)
+        ON CONFLICT (message_sid) DO UPDATE SET reply = EXCLUDED.reply
+    """, (WEBHOOK_DEDUP_TTL_SECONDS, message_sid, reply))
+
+
+# ---------- User Settings Utilities ----------
+async def get_user_settings(c, user_id):
+    try:
+        await c.execute("SELECT key, value FROM user_settings WHERE user_id = %s", (user_id,))
+        rows = await c.fetchall()
+        result = {}
+        for key, value in rows:
+            try:
+                result[key] = json.loads(value)
+            except (json.JSONDecodeError, TypeError):
+                result[key] = value
+        return result
+    except Exception:
+        logging.exception("Error fetching user settings")
+        return {}
+
+async def set_user_setting(c, user_id, key, value):
+    try:
+        value_str = json.dumps(value)
+        await c.execute("""
+            INSERT INTO user_settings (user_id, key, value)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, key) DO UPDATE SET value = EXCLUDED.value
+        """, (user_id, key, value_str))
+    except Exception:
+        logging.exception("Error setting user setting")
+
+async def set_multiple_settings(c, user_id, settings_dict, bump_cache=False):
+    rows = [(user_id, key, json.dumps(value)) for key, value in settings_dict.items()]
+    if bump_cache:
+        rows.append((user_id, CACHE_GENERATION_KEY, '1'))
+    try:
+        # The cache generation is incremented in place so concurrent bumps are never lost
+        await execute_values(c, """
+            INSERT INTO user_settings (user_id, key, value)
+            VALUES %s
+            ON CONFLICT (user_id, key) DO UPDATE SET value = CASE
+                WHEN EXCLUDED.key = 'cache_generation' THEN (COALESCE(user_settings.value, '0')::bigint + 1)::text
+                ELSE EXCLUDED.value END
+        """, rows)
+    except Exception:
+        logging.exception("Error setting user settings")
+
+async def bump_cache_generation(c, user_id):
+    """Invalidates every cached read reply of the user."""
+    await set_multiple_settings(c, user_id, {}, bump_cache=True)
+
+async def get_user_by_phonenumber(phone_number, c):
+    try:
+        await c.execute("SELECT id FROM users WHERE phone_number = %s", (phone_number,))
+        row = await c.fetchone()
+        return {"user_id": row[0]} if row else None
+    except Exception:
+        logging.error("Error fetching user info", exc_info=True)
+        return None
+
+async def get_user_by_user_id(user_id, c):
+    try:
+        await c.execute("SELECT id, name, phone_number FROM users WHERE id = %s", (user_id,))
+        row = await c.fetchone()
+        return {'user_id': row[0], 'name': row[1], 'phone_number': row[2]} if row else None
+    except Exception as e:
+        logging.error(e)
+        return None
@@ -1,6 +1,10 @@
 import os
 import base64
 import re
+import html
+import json
+import time
+import socket
 import requests
 import logging
 from datetime import datetime
@@ -10,6 +14,11 @@ from email import message_from_bytes
 from bs4 import BeautifulSoup
 from google.auth.transport.requests import Request
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
 # === Logging Setup ===
 logging.basicConfig(
     level=logging.INFO,
@@ -19,6 +28,19 @@ logger = logging.getLogger(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 API_BASE = API_BASE = os.getenv("API_BASE_URL", "https://expenseapp-git-main-subhajits-projects-82cd4a28.vercel.app")
+# EMAIL_PREFILTER=1 fetches metadata first and skips messages whose complete snippet rules out every
+# pattern. Gmail's sizeEstimate counts the headers, so real mail always looks truncated and is
+# fetched anyway; off by default, since the metadata call then only adds a request per message.
+EMAIL_PREFILTER = os.getenv("EMAIL_PREFILTER", "0") == "1"
+# Gmail cuts snippets at about 200 characters; longer ones may be hiding the rest of the body.
+SNIPPET_TRUNCATED_AT = int(os.getenv("EMAIL_SNIPPET_TRUNCATED_AT", 150))
+# It also cuts shorter ones at word and entity boundaries, so only a snippet ending like a sentence
+# or a footer can be the whole body.
+SNIPPET_COMPLETE_ENDINGS = (".", "!", "?", ")", "]", '"', "'")
+MIN_ANCHOR_LENGTH = 3
+# Workers lease one user at a time from /api/reader-jobs and renew the lease while they work on it.
+WORKER_ID = os.getenv("READER_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+READER_LEASE_SECONDS = int(os.getenv("READER_LEASE_SECONDS", 300))
 
 
 def sanitize_text(text):
@@ -26,11 +48,73 @@ def sanitize_text(text):
         return ""
     return re.sub(r'\s+', ' ', text)
 
+def pattern_anchors(regex):
+    """
+    The literal runs every match of regex contains, lowercased and in order, e.g.
+    'Rs\\.(?P<amount>[0-9,.]+) has been debited' -> ['rs.', 'has been debited'].
+    """
+    try:
+        parsed = sre_parse.parse(regex)
+    except re.error:
+        return []
+    anchors, run = [], []
+
+    def flush():
+        text = sanitize_text("".join(run)).strip().lower()
+        run.clear()
+        if len(text) >= MIN_ANCHOR_LENGTH:
+            anchors.append(text)
+
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(av))
+            elif op is sre_parse.SUBPATTERN:
+                walk(av[-1])
+            elif op is not sre_parse.AT:
+                flush()
+
+    walk(parsed)
+    flush()
+    return anchors
+
+def snippet_may_match(text, anchors):
+    """Whether text, a complete body, holds every anchor of a pattern in order."""
+    position = 0
+    for anchor in anchors:
+        found = text.find(anchor, position)
+        if found < 0:
+            return False
+        position = found + len(anchor)
+    return True
+
+def snippet_truncated(snippet, size_estimate):
+    """
+    Whether the body may go on past the snippet. Fails open: a snippet counts as the whole body
+    only when it is short, ends like a sentence and the message is no larger than it.
+    """
+    snippet = snippet.rstrip()
+    return (len(snippet) >= SNIPPET_TRUNCATED_AT or not snippet.endswith(SNIPPET_COMPLETE_ENDINGS)
+            or size_estimate > len(snippet.encode("utf-8")))
+
+def is_candidate(msg_meta, pattern_anchor_lists):
+    """Whether the Subject and snippet of a metadata fetch could match any pattern."""
+    headers = msg_meta.get('payload', {}).get('headers', [])
+    subject = next((h['value'] for h in headers if h.get('name', '').lower() == 'subject'), "")
+    snippet = html.unescape(msg_meta.get('snippet', ""))
+    text = sanitize_text(f"{subject} {snippet}").lower()
+    if snippet_truncated(snippet, msg_meta.get('sizeEstimate', 0)):
+        # re.search may find the match anywhere past the cut, so nothing can be ruled out
+        return True
+    return any(snippet_may_match(text, anchors) for anchors in pattern_anchor_lists)
+
+def response_bytes(response):
+    return len(json.dumps(response))
+
 def authenticate_gmail(token_str):
     try:
-        with open('token.json', 'w') as f:
-            f.write(token_str)
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        # In memory: workers sharing a directory must not swap each other's tokens through a file.
+        creds = Credentials.from_authorized_user_info(json.loads(token_str), SCOPES)
 
         if not creds.valid:
             if creds.expired and creds.refresh_token:
@@ -105,126 +189,228 @@ def get_sender_by_pattern_type(pattern_type):
         return "alerts@hdfcbank.net"
     return "alerts@hdfcbank.net"   # Default fallback
 
-def poll_and_process():
-    try:
-        email_configs = requests.get(f"{API_BASE}/api/email-configs").json()
-    except Exception as e:
-        logger.error("Failed to fetch email configs: %s", e)
-        return
-
-    for config in email_configs:
-        credit_count = 0
-        debit_count = 0
-        logger.info(f"\n======== starting trasactional fetch for user {config['user_id']} ======\n")
-        user_id = config['user_id']
-        email_config_id = config['email_config_id']
-        token = config['token']
-        last_fetch_time = config.get('last_email_fetch_time')
-        last_fetch_id = config.get('last_fetched_email_id')
-        patterns = config.get('patterns', [])
-
-        if not token:
-            logger.warning("No token available for user_id=%s", user_id)
-            continue
-
+class LeaseLost(Exception):
+    """The job's lease expired and another worker may have taken the user over."""
+
+
+class Lease:
+    """A leased reader job: heartbeats while the user is processed, then completes it."""
+    def __init__(self, config):
+        self.email_config_id = config['email_config_id']
+        self.token = config['lease_token']
+        self.renewed_at = time.monotonic()
+
+    def keep_alive(self):
+        """Renews the lease once a third of it has passed; raises LeaseLost when it is gone."""
+        if time.monotonic() - self.renewed_at < READER_LEASE_SECONDS / 3:
+            return
+        response = requests.post(
+            f"{API_BASE}/api/reader-jobs/{self.email_config_id}/heartbeat",
+            json={"lease_token": self.token, "lease_seconds": READER_LEASE_SECONDS}
+        )
+        if response.status_code == 409:
+            raise LeaseLost()
+        response.raise_for_status()
+        self.renewed_at = time.monotonic()
+
+    def complete(self, error=None):
         try:
-            creds = authenticate_gmail(token)
-            service = build('gmail', 'v1', credentials=creds)
+            response = requests.post(
+                f"{API_BASE}/api/reader-jobs/{self.email_config_id}/complete",
+                json={"lease_token": self.token, "error": error}
+            )
+            if response.status_code != 200:
+                logger.warning("Could not complete reader job %s: %s", self.email_config_id, response.text)
+        except Exception as e:
+            # The lease expires on its own and the job is picked up again.
+            logger.error("Failed to complete reader job %s: %s", self.email_config_id, e)
 
-            # Build unified Gmail query for all patterns
-            senders = set(get_sender_by_pattern_type(p['type']) for p in patterns)
-            query = " OR ".join([f"from:{sender}" for sender in senders])
 
-            if last_fetch_time:
-                try:
-                    after_ts = int(datetime.strptime(last_fetch_time, "%a, %d %b %Y %H:%M:%S %Z").timestamp())
-                    query += f" after:{after_ts}"
-                except Exception as e:
-                    logger.warning("Could not parse last_email_fetch_time: %s", e)
+def poll_and_process():
+    """Leases due users one at a time until none is left. Any number of workers can run this side by side."""
+    # Bytes are the JSON size of the Gmail responses; bytes avoided are the sizeEstimate of skipped messages.
+    run_stats = {"messages": 0, "skipped": 0, "bytes_downloaded": 0, "bytes_avoided": 0}
+    while True:
+        try:
+            response = requests.post(
+                f"{API_BASE}/api/reader-jobs/lease",
+                json={"worker_id": WORKER_ID, "limit": 1, "lease_seconds": READER_LEASE_SECONDS}
+            )
+            response.raise_for_status()
+            leased = response.json()
+        except Exception as e:
+            logger.error("Failed to lease reader jobs: %s", e)
+            break
+        if not leased:
+            logger.info("No users due, worker %s is done", WORKER_ID)
+            break
+
+        for config in leased:
+            lease = Lease(config)
+            try:
+                error = process_config(config, run_stats, lease)
+            except LeaseLost:
+                logger.warning("Lease on user_id=%s expired, leaving the user to its new worker", config['user_id'])
+                continue
+            lease.complete(error)
+
+    log_fetch_stats("run", run_stats)
+
+
+def process_config(config, run_stats, lease):
+    """Stages the new transaction emails of one leased email config. Returns an error message if the run failed."""
+    error = None
+    credit_count = 0
+    debit_count = 0
+    stats = {"messages": 0, "skipped": 0, "bytes_downloaded": 0, "bytes_avoided": 0}
+    logger.info(f"\n======== starting trasactional fetch for user {config['user_id']} ======\n")
+    user_id = config['user_id']
+    email_config_id = config['email_config_id']
+    token = config['token']
+    last_fetch_time = config.get('last_email_fetch_time')
+    last_fetch_id = config.get('last_fetched_email_id')
+    patterns = config.get('patterns', [])
+    pattern_anchor_lists = [pattern_anchors(p["pattern_text"]) for p in patterns]
+
+    if not token:
+        logger.warning("No token available for user_id=%s", user_id)
+        return None
+
+    if not patterns:
+        # Without a sender to search for, the query would list arbitrary inbox mail
+        logger.warning("No active patterns for user_id=%s", user_id)
+        return None
+
+    try:
+        creds = authenticate_gmail(token)
+        service = build('gmail', 'v1', credentials=creds)
 
-            logger.info("Fetching messages for user_id=%s with query=%s", user_id, query)
-            messages_result = service.users().messages().list(
-                userId='me', q=query, maxResults=50
-            ).execute()
+        # Build unified Gmail query for all patterns
+        senders = set(get_sender_by_pattern_type(p['type']) for p in patterns)
+        query = " OR ".join([f"from:{sender}" for sender in senders])
 
-            messages = messages_result.get('messages', [])
-            logger.info("Found %d emails for user_id=%s", len(messages), user_id)
+        if last_fetch_time:
+            try:
+                after_ts = int(datetime.strptime(last_fetch_time, "%a, %d %b %Y %H:%M:%S %Z").timestamp())
+                query += f" after:{after_ts}"
+            except Exception as e:
+                logger.warning("Could not parse last_email_fetch_time: %s", e)
 
-            for msg in messages:
-                msg_id = msg['id']
+        logger.info("Fetching messages for user_id=%s with query=%s", user_id, query)
+        messages_result = service.users().messages().list(
+            userId='me', q=query, maxResults=50
+        ).execute()
 
-                if msg_id == last_fetch_id:
-                    logger.info("Reached last fetched email. Skipping further.")
-                    break
+        messages = messages_result.get('messages', [])
+        logger.info("Found %d emails for user_id=%s", len(messages), user_id)
 
-                try:
-                    msg_data = service.users().messages().get(
-                        userId='me', id=msg_id, format='full'
-                    ).execute()
+        for msg in messages:
+            msg_id = msg['id']
 
-                    payload = msg_data.get('payload', {})
-                    email_text = extract_text_from_payload(payload)
-                    email_text = sanitize_text(email_text)
+            if msg_id == last_fetch_id:
+                logger.info("Reached last fetched email. Skipping further.")
+                break
 
-                    if not email_text:
-                        logger.warning("Empty email for message ID: %s", msg_id)
+            try:
+                lease.keep_alive()
+                stats["messages"] += 1
+                if EMAIL_PREFILTER:
+                    # Subject and snippet only; the MIME tree is fetched for candidates alone.
+                    msg_meta = service.users().messages().get(
+                        userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject']
+                    ).execute()
+                    stats["bytes_downloaded"] += response_bytes(msg_meta)
+                    if not is_candidate(msg_meta, pattern_anchor_lists):
+                        stats["skipped"] += 1
+                        stats["bytes_avoided"] += msg_meta.get('sizeEstimate', 0)
+                        logger.info("Snippet matches no pattern, skipping message ID: %s", msg_id)
                         continue
 
-                    matched = False
-                    for pattern in patterns:
-                        regex = pattern["pattern_text"]
-                        pattern_type = pattern["type"]
-                        parsed = parse_transaction_details(email_text, regex, pattern_type)
-                        if parsed:
-                            
-                            parsed["user_id"] = user_id
-                            matched = True
-                            print(parsed)
-
-                            response = requests.post(
-                                f"{API_BASE}/api/staged-transactions",
-                                json={
-                                    "transaction_date": parsed["transaction_date"],
-                                    "action": parsed["action"],
-                                    "amount": parsed["amount"],
-                                    "user_id": parsed["user_id"],
-                                    "merchant": parsed.get("merchant"),
-                                    "transaction_ref": parsed.get("transaction_ref")
-                                }
+                msg_data = service.users().messages().get(
+                    userId='me', id=msg_id, format='full'
+                ).execute()
+                stats["bytes_downloaded"] += response_bytes(msg_data)
+
+                payload = msg_data.get('payload', {})
+                email_text = extract_text_from_payload(payload)
+                email_text = sanitize_text(email_text)
+
+                if not email_text:
+                    logger.warning("Empty email for message ID: %s", msg_id)
+                    continue
+
+                matched = False
+                for pattern in patterns:
+                    regex = pattern["pattern_text"]
+                    pattern_type = pattern["type"]
+                    parsed = parse_transaction_details(email_text, regex, pattern_type)
+                    if parsed:
+                        
+                        parsed["user_id"] = user_id
+                        matched = True
+                        print(parsed)
+
+                        response = requests.post(
+                            f"{API_BASE}/api/staged-transactions",
+                            json={
+                                "transaction_date": parsed["transaction_date"],
+                                "action": parsed["action"],
+                                "amount": parsed["amount"],
+                                "user_id": parsed["user_id"],
+                                "merchant": parsed.get("merchant"),
+                                "transaction_ref": parsed.get("transaction_ref")
+                            }
+                        )
+
+                        if response.status_code == 201:
+                            logger.info("Transaction saved for user_id=%s", user_id)
+                            if parsed["action"].lower() == "credit":
+                                credit_count += 1
+                            elif parsed["action"].lower() == "debit":
+                                debit_count += 1
+
+                            update_data = {
+                                "last_fetched_email_id": msg_id,
+                                "last_email_fetch_time": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"),
+                                "lease_token": lease.token
+                            }
+                            checkpoint = requests.put(
+                                f"{API_BASE}/api/users/{user_id}/email-configs/{email_config_id}",
+                                json=update_data
                             )
+                            if checkpoint.status_code == 409:
+                                raise LeaseLost()
+                        else:
+                            logger.error("Failed to save transaction: %s", response.text)
+                        break  # Stop trying patterns after a successful match
+
+                if not matched:
+                    print(email_text)
+                    logger.info("No matching pattern found for message ID: %s", msg_id)
+
+            except LeaseLost:
+                raise
+            except Exception as e:
+                logger.error("Error processing message ID %s: %s", msg_id, e)
 
-                            if response.status_code == 201:
-                                logger.info("Transaction saved for user_id=%s", user_id)
-                                if parsed["action"].lower() == "credit":
-                                    credit_count += 1
-                                elif parsed["action"].lower() == "debit":
-                                    debit_count += 1
-
-                                update_data = {
-                                    "last_fetched_email_id": msg_id,
-                                    "last_email_fetch_time": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
-                                }
-                                requests.put(
-                                    f"{API_BASE}/api/users/{user_id}/email-configs/{email_config_id}",
-                                    json=update_data
-                                )
-                            else:
-                                logger.error("Failed to save transaction: %s", response.text)
-                            break  # Stop trying patterns after a successful match
-
-                    if not matched:
-                        print(email_text)
-                        logger.info("No matching pattern found for message ID: %s", msg_id)
-
-                except Exception as e:
-                    logger.error("Error processing message ID %s: %s", msg_id, e)
+    except LeaseLost:
+        raise
+    except Exception as e:
+        logger.error("Error processing user_id %s: %s", user_id, e)
+        error = str(e)
+
+    
+    alert_user_for_transaction(user_id, credit_count, debit_count)
+    for key, value in stats.items():
+        run_stats[key] += value
+    log_fetch_stats(f"user_id={user_id}", stats)
+    logger.info(f"\n======== completed trasactional fetch for user {config['user_id']} ======\n")
+    return error
 
-        except Exception as e:
-            logger.error("Error processing user_id %s: %s", user_id, e)
 
-        
-        alert_user_for_transaction(user_id, credit_count, debit_count)
-        logger.info(f"\n======== completed trasactional fetch for user {config['user_id']} ======\n")
+def log_fetch_stats(scope, stats):
+    logger.info("📥 Fetch stats for %s: %d message(s), %d skipped by snippet, %.1f KB downloaded, %.1f KB avoided",
+                scope, stats["messages"], stats["skipped"], stats["bytes_downloaded"] / 1024, stats["bytes_avoided"] / 1024)
 
 
 def alert_user_for_transaction(user_id, credit_count, debit_count):
@@ -0,0 +1,330 @@
+"""
+Load test that replays WhatsApp webhook traffic against a local stack.
+
+Usage: BENCHMARK_DATABASE_URL=postgresql://localhost/expense_load DATABASE_SSLMODE=disable \\
+       python loadtest.py --seed --users 2000 --workers 16 --duration 30
+       python loadtest.py --compare --seed --workers 64 --duration 30
+
+The Flask app (--app wsgi) is served in-process on a werkzeug server limited to --sync-workers
+concurrent requests, like a gunicorn worker pool; --app asgi serves asgi.py on uvicorn. The
+Twilio client is replaced by a stub either way, so nothing leaves the machine. Pass --url to
+drive an already running server instead. Reports throughput, latency percentiles and error
+rate per command. --compare runs both apps in turn, each in a fresh process, and prints the
+totals side by side. CI runs it with SQL_QUERY_BUDGET_ENFORCE=1 and --max-error-rate 0.
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import logging
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import threading
+import urllib.parse
+import http.client
+import json
+from collections import defaultdict
+from datetime import date, timedelta
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+ITEMS = ["tea", "coffee", "lunch", "dinner", "cab", "auto", "snacks", "fuel", "groceries", "movie"]
+EVENTS = ["daily", "goa trip", "office"]
+ERROR_MARKERS = ("❌", "Something went wrong")
+
+
+class StubTwilioMessage:
+    def __init__(self):
+        self.sid = "SM" + uuid.uuid4().hex
+
+
+class StubTwilioClient:
+    """Stands in for twilio.rest.Client; messages.create sleeps for a typical API round trip."""
+    def __init__(self, latency=0.15):
+        self.latency = latency
+        self.messages = self
+
+    def create(self, body, from_, to):
+        time.sleep(self.latency)
+        return StubTwilioMessage()
+
+    async def create_async(self, body, from_, to):
+        await asyncio.sleep(self.latency)
+        return StubTwilioMessage()
+
+
+# ---------- Traffic ----------
+def webhook_form(phone, body):
+    """A Twilio WhatsApp webhook body as form-encoded by Twilio."""
+    sid = "SM" + uuid.uuid4().hex
+    return urllib.parse.urlencode({
+        "SmsMessageSid": sid,
+        "NumMedia": "0",
+        "ProfileName": "Load Test",
+        "MessageType": "text",
+        "SmsSid": sid,
+        "WaId": phone.lstrip("+"),
+        "SmsStatus": "received",
+        "Body": body,
+        "To": "whatsapp:+14155238886",
+        "NumSegments": "1",
+        "MessageSid": sid,
+        "AccountSid": "AC" + "0" * 32,
+        "From": f"whatsapp:{phone}",
+        "ApiVersion": "2010-04-01",
+    })
+
+
+def random_day(rng, days=60):
+    return (date.today() - timedelta(days=rng.randrange(days))).isoformat()
+
+
+def session(rng):
+    """One user interaction as a list of (command label, message body)."""
+    kind = rng.choices(
+        ["add", "show", "show date", "summary", "summary date", "summary month", "list", "tag", "add mode", "switch"],
+        weights=[30, 12, 4, 8, 3, 3, 10, 8, 8, 4])[0]
+    if kind == "add":
+        return [("add", f"add {rng.choice(ITEMS)} {rng.randint(5, 500)}")]
+    if kind == "show":
+        return [("show", "show")]
+    if kind == "show date":
+        return [("show date", f"show date {random_day(rng)}")]
+    if kind == "summary":
+        return [("summary", "summary")]
+    if kind == "summary date":
+        return [("summary date", f"summary date {random_day(rng)}")]
+    if kind == "summary month":
+        return [("summary month", f"summary month {random_day(rng, 365)[:7]}")]
+    if kind == "list":
+        return [("list", "list")]
+    if kind == "switch":
+        return [("switch", f"switch {rng.choice(EVENTS)}")]
+    if kind == "tag":
+        return [("show pending", "show pending"), ("tag", f"tag {rng.randint(1, 3)} {rng.choice(ITEMS)}")]
+    lines = [("add mode", "add")]
+    lines += [("add mode item", f"{rng.choice(ITEMS)} {rng.randint(5, 500)}") for _ in range(rng.randint(1, 5))]
+    return lines + [("add mode done", "done")]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, label, seconds, ok):
+        with self.lock:
+            self.latencies[label].append(seconds)
+            if not ok:
+                self.errors[label] += 1
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+class Driver:
+    """Keeps one HTTP connection per worker thread and times each request."""
+    def __init__(self, url, stats):
+        parsed = urllib.parse.urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.stats = stats
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def request(self, label, method, path, body, headers):
+        start = time.perf_counter()
+        ok = False
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            text = response.read().decode("utf-8", errors="replace")
+            ok = response.status < 400 and not any(marker in text for marker in ERROR_MARKERS)
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        self.stats.record(label, time.perf_counter() - start, ok)
+
+    def message(self, label, phone, body, retry=False):
+        form = webhook_form(phone, body)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        self.request(label, "POST", "/", form, headers)
+        if retry:
+            # Twilio redelivers the same MessageSid when a reply is slow.
+            self.request("retried delivery", "POST", "/", form, headers)
+
+    def staged_burst(self, user_ids, size, rng):
+        for _ in range(size):
+            payload = {
+                "user_id": rng.choice(user_ids),
+                "transaction_date": random_day(rng, 3),
+                "amount": round(rng.uniform(10, 5000), 2),
+                "action": rng.choice(["DEBIT", "CREDIT"]),
+                "merchant": rng.choice(["SWIGGY", "ZOMATO", "UBER INDIA", "AMAZON PAY"]),
+                "transaction_ref": uuid.uuid4().hex[:12],
+            }
+            self.request("staged-transactions", "POST", "/api/staged-transactions", json.dumps(payload),
+                         {"Content-Type": "application/json"})
+        # The email reader follows a burst with a WhatsApp alert, which goes through the Twilio client.
+        self.request("notify-whatsapp", "POST", f"/api/users/{rng.choice(user_ids)}/notify-whatsapp",
+                     json.dumps({"message": "💰 New transactions added. Type 'show pending' to review them."}),
+                     {"Content-Type": "application/json"})
+
+
+def worker(index, workers, url, users, deadline, stats, staged_every, staged_burst, retry_rate):
+    rng = random.Random(index)
+    driver = Driver(url, stats)
+    # Phones are partitioned so an add-mode session never interleaves with another worker's.
+    user_ids = list(range(index + 1, users + 1, workers))
+    sessions = 0
+    while time.perf_counter() < deadline:
+        user_id = rng.choice(user_ids)
+        phone = "+91" + str(user_id).zfill(10)
+        for label, body in session(rng):
+            driver.message(label, phone, body, retry=rng.random() < retry_rate)
+        sessions += 1
+        if staged_every and sessions % staged_every == 0:
+            driver.staged_burst(user_ids, staged_burst, rng)
+
+
+def bounded(wsgi_app, workers):
+    """Lets at most `workers` requests run at once; the rest queue as they would for a busy pool."""
+    slots = threading.BoundedSemaphore(workers)
+
+    def app(environ, start_response):
+        with slots:
+            return list(wsgi_app(environ, start_response))
+    return app
+
+
+def serve_in_process(port, twilio_latency, sync_workers):
+    from werkzeug.serving import make_server
+    import index
+
+    index.client = StubTwilioClient(twilio_latency)
+    app = bounded(index.app, sync_workers) if sync_workers else index.app
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_asgi_in_process(port, twilio_latency):
+    import uvicorn
+    import asgi
+
+    asgi.client = StubTwilioClient(twilio_latency)
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def report(stats, elapsed):
+    total = sum(len(v) for v in stats.latencies.values())
+    total_errors = sum(stats.errors.values())
+    logging.info(f"\n{'command':<22}{'count':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>9}")
+    for label in sorted(stats.latencies):
+        values = sorted(stats.latencies[label])
+        errors = stats.errors.get(label, 0)
+        logging.info(f"{label:<22}{len(values):>8}{len(values) / elapsed:>9.1f}"
+                     f"{percentile(values, 50) * 1000:>9.1f}{percentile(values, 95) * 1000:>9.1f}"
+                     f"{percentile(values, 99) * 1000:>9.1f}{values[-1] * 1000:>9.1f}"
+                     f"{errors / len(values):>9.1%}")
+    everything = sorted(v for values in stats.latencies.values() for v in values)
+    logging.info(f"{'total':<22}{total:>8}{total / elapsed:>9.1f}"
+                 f"{percentile(everything, 50) * 1000:>9.1f}{percentile(everything, 95) * 1000:>9.1f}"
+                 f"{percentile(everything, 99) * 1000:>9.1f}{(everything[-1] if everything else 0) * 1000:>9.1f}"
+                 f"{(total_errors / total if total else 0):>9.1%}")
+    return {"requests": total, "rps": total / elapsed, "p50": percentile(everything, 50) * 1000,
+            "p95": percentile(everything, 95) * 1000, "p99": percentile(everything, 99) * 1000,
+            "errors": total_errors / total if total else 0}
+
+
+def compare(argv):
+    """Runs this script once per app in a fresh process and prints the totals side by side."""
+    results = {}
+    for app in ("wsgi", "asgi"):
+        logging.info(f"\n===== {app} =====")
+        with tempfile.NamedTemporaryFile(suffix=".json") as out:
+            subprocess.run([sys.executable, __file__, *argv, "--app", app, "--result-file", out.name], check=True)
+            results[app] = json.load(open(out.name))
+    logging.info(f"\n{'app':<8}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>9}")
+    for app, r in results.items():
+        logging.info(f"{app:<8}{r['requests']:>10}{r['rps']:>9.1f}{r['p50']:>9.1f}{r['p95']:>9.1f}{r['p99']:>9.1f}{r['errors']:>9.1%}")
+    logging.info(f"asgi/wsgi throughput: {results['asgi']['rps'] / results['wsgi']['rps']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="drive a running server instead of serving index.app in-process")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--users", type=int, default=2000, help="simulated phone numbers")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--seed", action="store_true", help="truncate and seed BENCHMARK_DATABASE_URL first")
+    parser.add_argument("--rows-per-event", type=int, default=100)
+    parser.add_argument("--staged-every", type=int, default=20, help="sessions between staged-transaction bursts (0 = off)")
+    parser.add_argument("--staged-burst", type=int, default=25, help="staged transactions per burst")
+    parser.add_argument("--retry-rate", type=float, default=0.05, help="share of webhooks redelivered with the same MessageSid")
+    parser.add_argument("--twilio-latency", type=float, default=0.15, help="stubbed Twilio call time in seconds")
+    parser.add_argument("--app", choices=["wsgi", "asgi"], default="wsgi", help="serve index.py or asgi.py in-process")
+    parser.add_argument("--sync-workers", type=int, default=8, help="concurrent requests the wsgi app may serve (0 = unbounded)")
+    parser.add_argument("--compare", action="store_true", help="load both apps in turn and compare throughput")
+    parser.add_argument("--max-error-rate", type=float, help="exit non-zero when the total error rate is above this, e.g. 0")
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare([arg for arg in sys.argv[1:] if arg != "--compare"])
+        return
+
+    url = args.url
+    if not url:
+        database_url = os.getenv("BENCHMARK_DATABASE_URL")
+        if not database_url:
+            sys.exit("Set BENCHMARK_DATABASE_URL to a scratch database to serve the app in-process.")
+        os.environ["DATABASE_URL"] = database_url
+        if args.seed:
+            from benchmark import get_bench_conn, seed_database
+            conn = get_bench_conn()
+            seed_database(conn, args.users, args.rows_per_event)
+            conn.close()
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        if args.app == "asgi":
+            serve_asgi_in_process(args.port, args.twilio_latency)
+        else:
+            serve_in_process(args.port, args.twilio_latency, args.sync_workers)
+        url = f"http://127.0.0.1:{args.port}"
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stats = Stats()
+    deadline = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=worker, args=(i, args.workers, url, args.users, deadline, stats,
+                                                     args.staged_every, args.staged_burst, args.retry_rate))
+               for i in range(args.workers)]
+    start = time.perf_counter()
+    # index.py prints on some paths; keep the report readable.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    logging.getLogger().setLevel(logging.INFO)
+    totals = report(stats, time.perf_counter() - start)
+    if args.result_file:
+        with open(args.result_file, "w") as f:
+            json.dump(totals, f)
+    # With SQL_QUERY_BUDGET_ENFORCE=1 a request over its query budget answers 500 and counts as an error.
+    if args.max_error_rate is not None and totals["errors"] > args.max_error_rate:
+        sys.exit(f"Error rate {totals['errors']:.1%} is above --max-error-rate {args.max_error_rate:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+In-process metrics with a Prometheus text exposition.
+
+Counters, gauges and histograms are keyed by label values and guarded by a lock per metric.
+Recording is a dict lookup, a bisect and a few additions, cheap enough for the webhook hot path.
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _format_labels(label_names, values, extra=()):
+    pairs = list(zip(label_names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per-bucket counts (last slot is +Inf), sum, count
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((labels, ([*state[0]], state[1], state[2])) for labels, state in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Application metrics ----------
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Request latency by route.", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served.", ["route"])
+REQUEST_ERRORS = Counter("http_request_errors_total", "Requests that raised or returned a 5xx.", ["route"])
+DB_CONNECT_LATENCY = Histogram("db_connect_duration_seconds", "Time to open a database connection.")
+DB_QUERY_LATENCY = Histogram("db_query_duration_seconds", "Time spent executing SQL statements.", ["route"])
+DB_QUERIES_PER_REQUEST = Histogram("db_queries_per_request", "SQL statements issued per request.", ["route"],
+                                   buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50))
+DB_ERRORS = Counter("db_errors_total", "Failed database connects and statements.", ["stage"])
+TWILIO_LATENCY = Histogram("twilio_request_duration_seconds", "Time spent calling the Twilio API.", ["operation"])
+TWILIO_ERRORS = Counter("twilio_errors_total", "Failed Twilio API calls.", ["operation"])
+RENDER_LATENCY = Histogram("response_render_duration_seconds", "Time spent building JSON responses.", ["route"])
+REPLY_CACHE_REQUESTS = Counter("reply_cache_requests_total", "Reply cache lookups by tier and result.", ["tier", "result"])
+WEBHOOK_COMMANDS = Counter("webhook_commands_total", "WhatsApp commands received.", ["command"])
@@ -0,0 +1,352 @@
+"""
+Versioned schema migrations.
+
+Usage: python migrations.py           # apply pending migrations
+       python migrations.py status    # list applied / pending versions
+
+Each migration runs in its own transaction and is recorded in schema_migrations.
+Migrations are append-only: never edit one that has been applied, add a new version instead.
+"""
+import os
+import sys
+import logging
+import psycopg2
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_SSLMODE = os.getenv("DATABASE_SSLMODE", "require")
+
+MIGRATIONS = [
+    (1, "base schema", """
+        -- Tables as they exist in production; IF NOT EXISTS makes this a no-op there.
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            name TEXT,
+            phone_number TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS events (
+            event_id SERIAL PRIMARY KEY,
+            event_name TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            UNIQUE (user_id, event_name)
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            tran_id SERIAL PRIMARY KEY,
+            event_id INTEGER REFERENCES events(event_id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            date TIMESTAMP,
+            action TEXT,
+            item TEXT,
+            amount NUMERIC(12, 2),
+            merchant TEXT,
+            transaction_ref TEXT,
+            created_at TIMESTAMP DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (user_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS user_email_configs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            email TEXT,
+            provider TEXT,
+            token TEXT,
+            last_fetched_email_id TEXT,
+            last_email_fetch_time TEXT
+        );
+        CREATE TABLE IF NOT EXISTS email_patterns (
+            id SERIAL PRIMARY KEY,
+            type TEXT NOT NULL,
+            pattern_text TEXT NOT NULL,
+            source TEXT
+        );
+        CREATE TABLE IF NOT EXISTS user_email_patterns (
+            id SERIAL PRIMARY KEY,
+            user_email_config_id INTEGER NOT NULL REFERENCES user_email_configs(id),
+            email_pattern_id INTEGER NOT NULL REFERENCES email_patterns(id),
+            active BOOLEAN NOT NULL DEFAULT TRUE
+        );
+    """),
+    (2, "hot query indexes", """
+        -- Webhook: user lookup on every message.
+        CREATE INDEX IF NOT EXISTS idx_users_phone_number ON users (phone_number);
+        -- user_settings (user_id, key) is served by its primary key.
+        -- show / summary filter on (user_id, event_id, date).
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_event_date ON transactions (user_id, event_id, date);
+        -- Transactions API filters on user and date and pages by date.
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date);
+        -- show pending: only untagged rows, which stay a small fraction of the table.
+        CREATE INDEX IF NOT EXISTS idx_transactions_pending ON transactions (user_id, event_id) WHERE item IS NULL;
+        -- Email-configs join only follows active pattern links.
+        CREATE INDEX IF NOT EXISTS idx_user_email_patterns_active
+            ON user_email_patterns (user_email_config_id, email_pattern_id) WHERE active;
+        CREATE INDEX IF NOT EXISTS idx_user_email_configs_user ON user_email_configs (user_id);
+    """),
+    (3, "typed transactions.date", """
+        -- Works from either the text or the timestamp column; blanks become NULL.
+        ALTER TABLE transactions
+            ALTER COLUMN date TYPE DATE USING NULLIF(btrim(date::text), '')::date;
+        UPDATE transactions SET date = created_at::date WHERE date IS NULL AND created_at IS NOT NULL;
+    """),
+    (4, "webhook message dedup", """
+        -- Twilio MessageSid of each handled webhook delivery with the TwiML reply sent.
+        CREATE TABLE IF NOT EXISTS webhook_messages (
+            message_sid TEXT PRIMARY KEY,
+            reply TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS idx_webhook_messages_created_at ON webhook_messages (created_at);
+    """),
+    (5, "shared reply cache", """
+        -- Optional shared tier of reply_cache.py. Unlogged: losing it on a crash only costs misses.
+        CREATE UNLOGGED TABLE IF NOT EXISTS reply_cache (
+            cache_key TEXT PRIMARY KEY,
+            reply TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_reply_cache_expires_at ON reply_cache (expires_at);
+    """),
+    (6, "monthly transactions partitions", """
+        -- Declarative range partitions by month; partitions.py creates future ones and archives old ones.
+        -- The primary key must include the partition key, so date becomes NOT NULL and part of it.
+        ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+        CREATE TABLE transactions (
+            tran_id INTEGER NOT NULL,
+            event_id INTEGER REFERENCES events(event_id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            date DATE NOT NULL,
+            action TEXT,
+            item TEXT,
+            amount NUMERIC(12, 2),
+            merchant TEXT,
+            transaction_ref TEXT,
+            created_at TIMESTAMP DEFAULT now()
+        ) PARTITION BY RANGE (date);
+        -- Catches rows for months without a partition until partitions.py creates it.
+        CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;
+
+        -- Creates the partition holding p_month, moving any of its rows out of the default
+        -- partition first. Returns the partition name, or NULL when it already exists.
+        CREATE OR REPLACE FUNCTION create_transactions_partition(p_month DATE) RETURNS TEXT AS $$
+        DECLARE
+            p_start DATE := date_trunc('month', p_month)::date;
+            p_end DATE := (date_trunc('month', p_month) + interval '1 month')::date;
+            p_name TEXT := 'transactions_y' || to_char(p_month, 'YYYY') || 'm' || to_char(p_month, 'MM');
+        BEGIN
+            IF to_regclass(p_name) IS NOT NULL THEN
+                RETURN NULL;
+            END IF;
+            CREATE TEMP TABLE IF NOT EXISTS transactions_moved (LIKE transactions) ON COMMIT DROP;
+            WITH moved AS (
+                DELETE FROM transactions_default WHERE date >= p_start AND date < p_end RETURNING *
+            )
+            INSERT INTO transactions_moved SELECT * FROM moved;
+            EXECUTE format('CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)', p_name, p_start, p_end);
+            INSERT INTO transactions SELECT * FROM transactions_moved;
+            TRUNCATE transactions_moved;
+            RETURN p_name;
+        END
+        $$ LANGUAGE plpgsql;
+
+        SELECT create_transactions_partition(m::date)
+        FROM generate_series(
+            date_trunc('month', LEAST(CURRENT_DATE, (SELECT min(COALESCE(date, created_at::date)) FROM transactions_unpartitioned))),
+            date_trunc('month', CURRENT_DATE) + interval '3 months',
+            interval '1 month') m;
+
+        INSERT INTO transactions (tran_id, event_id, user_id, date, action, item, amount, merchant, transaction_ref, created_at)
+        SELECT tran_id, event_id, user_id, COALESCE(date, created_at::date, CURRENT_DATE),
+               action, item, amount, merchant, transaction_ref, created_at
+        FROM transactions_unpartitioned;
+
+        -- Keep the SERIAL sequence: new ids continue where the old table stopped.
+        DO $$
+        DECLARE seq TEXT := pg_get_serial_sequence('transactions_unpartitioned', 'tran_id');
+        BEGIN
+            EXECUTE format('ALTER TABLE transactions ALTER COLUMN tran_id SET DEFAULT nextval(%L)', seq);
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY transactions.tran_id', seq);
+        END
+        $$;
+
+        -- Nothing may be lost in the copy: every old column must exist on the new table and every row must have moved.
+        DO $$
+        DECLARE
+            missing TEXT;
+            old_rows BIGINT;
+            new_rows BIGINT;
+        BEGIN
+            SELECT string_agg(column_name, ', ') INTO missing FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'transactions_unpartitioned'
+              AND column_name NOT IN (SELECT column_name FROM information_schema.columns
+                                      WHERE table_schema = current_schema() AND table_name = 'transactions');
+            IF missing IS NOT NULL THEN
+                RAISE EXCEPTION 'Partitioned transactions table lacks columns of the original: %', missing;
+            END IF;
+            SELECT count(*) INTO old_rows FROM transactions_unpartitioned;
+            SELECT count(*) INTO new_rows FROM transactions;
+            IF old_rows <> new_rows THEN
+                RAISE EXCEPTION 'Copied % of % transactions', new_rows, old_rows;
+            END IF;
+        END
+        $$;
+
+        -- The original table is kept in the archive schema partitions.py archives to. Moving it also
+        -- frees its index names for the new table's.
+        ALTER TABLE transactions_unpartitioned ALTER COLUMN tran_id DROP DEFAULT;
+        CREATE SCHEMA IF NOT EXISTS archive;
+        ALTER TABLE transactions_unpartitioned SET SCHEMA archive;
+
+        -- Indexes on the parent cascade to every partition, present and future.
+        ALTER TABLE transactions ADD PRIMARY KEY (tran_id, date);
+        CREATE INDEX idx_transactions_user_event_date ON transactions (user_id, event_id, date);
+        CREATE INDEX idx_transactions_user_date ON transactions (user_id, date);
+        CREATE INDEX idx_transactions_pending ON transactions (user_id, event_id, date) WHERE item IS NULL;
+        ANALYZE transactions;
+    """),
+    (7, "merchant rules", """
+        -- Normalised merchant name shared by rule learning (tag) and lookup (staged ingestion).
+        CREATE OR REPLACE FUNCTION merchant_key(merchant TEXT) RETURNS TEXT AS $$
+            SELECT NULLIF(upper(regexp_replace(btrim(merchant), '\\s+', ' ', 'g')), '')
+        $$ LANGUAGE sql IMMUTABLE;
+
+        -- Per-user merchant -> item, learned from tags; the primary key is the lookup index.
+        CREATE TABLE IF NOT EXISTS merchant_rules (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            merchant TEXT NOT NULL,
+            item TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 1,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, merchant)
+        );
+
+        -- Seed from past tags: each merchant's most used item.
+        INSERT INTO merchant_rules (user_id, merchant, item, hits)
+        SELECT DISTINCT ON (user_id, merchant) user_id, merchant, item, hits
+        FROM (
+            SELECT user_id, merchant_key(merchant) AS merchant, item, count(*) AS hits
+            FROM transactions
+            WHERE merchant_key(merchant) IS NOT NULL AND item IS NOT NULL
+            GROUP BY 1, 2, 3
+        ) tagged
+        ORDER BY user_id, merchant, hits DESC
+        ON CONFLICT (user_id, merchant) DO NOTHING;
+    """),
+    (8, "email reader job leases", """
+        -- One job per email config. A worker leases due jobs with FOR UPDATE SKIP LOCKED; a lease
+        -- that is not renewed by heartbeats before lease_expires_at makes the job due again.
+        CREATE TABLE IF NOT EXISTS reader_jobs (
+            email_config_id INTEGER PRIMARY KEY REFERENCES user_email_configs(id) ON DELETE CASCADE,
+            next_run_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            lease_token UUID,
+            leased_by TEXT,
+            lease_expires_at TIMESTAMPTZ,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            last_completed_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS idx_reader_jobs_next_run_at ON reader_jobs (next_run_at);
+
+        INSERT INTO reader_jobs (email_config_id) SELECT id FROM user_email_configs
+        ON CONFLICT (email_config_id) DO NOTHING;
+
+        -- New email configs are due straight away.
+        CREATE OR REPLACE FUNCTION create_reader_job() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO reader_jobs (email_config_id) VALUES (NEW.id) ON CONFLICT (email_config_id) DO NOTHING;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS user_email_configs_reader_job ON user_email_configs;
+        CREATE TRIGGER user_email_configs_reader_job AFTER INSERT ON user_email_configs
+            FOR EACH ROW EXECUTE FUNCTION create_reader_job();
+    """),
+    (9, "trigram search on merchant and item", """
+        -- Substring and fuzzy search (find <text>, /transactions/search). btree_gin lets user_id sit
+        -- in the same GIN index, so a search only reads the searching user's trigram postings.
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE EXTENSION IF NOT EXISTS btree_gin;
+        CREATE INDEX IF NOT EXISTS idx_transactions_merchant_trgm ON transactions USING gin (user_id, merchant gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_transactions_item_trgm ON transactions USING gin (user_id, item gin_trgm_ops);
+    """),
+    (10, "event running totals", """
+        -- Kept current by the statements that insert or retag transactions (commands.event_totals_sql),
+        -- so list and show read them off the event row instead of summing its transactions.
+        -- total_spent leaves out credits; item_count counts every transaction of the event.
+        ALTER TABLE events
+            ADD COLUMN IF NOT EXISTS total_spent NUMERIC(14,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS item_count INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS last_activity_at TIMESTAMPTZ;
+
+        UPDATE events e SET total_spent = t.spent, item_count = t.items, last_activity_at = t.last_at
+        FROM (
+            SELECT event_id, COALESCE(SUM(amount) FILTER (WHERE upper(action) IS DISTINCT FROM 'CREDIT'), 0) AS spent,
+                   count(*) AS items, max(created_at) AS last_at
+            FROM transactions WHERE event_id IS NOT NULL GROUP BY event_id
+        ) t
+        WHERE e.event_id = t.event_id;
+    """),
+]
+
+
+def get_conn(database_url=None):
+    return psycopg2.connect(database_url or DATABASE_URL, sslmode=DATABASE_SSLMODE)
+
+
+def applied_versions(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(conn):
+    """Applies every pending migration in version order. Returns the versions applied."""
+    with conn:
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+
+    applied = []
+    for version, name, sql in sorted(MIGRATIONS):
+        if version in done:
+            continue
+        logging.info(f"Applying migration {version}: {name}")
+        with conn:
+            with conn.cursor() as cur:
+                # Serialise concurrent runners; the loser re-checks and skips.
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+                cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+                if cur.fetchone():
+                    continue
+                cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        applied.append(version)
+    return applied
+
+
+def status(conn):
+    with conn:
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+    for version, name, _ in sorted(MIGRATIONS):
+        print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {name}")
+
+
+if __name__ == "__main__":
+    conn = get_conn()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "status":
+            status(conn)
+        else:
+            applied = migrate(conn)
+            logging.info(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+    finally:
+        conn.close()
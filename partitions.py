@@ -0,0 +1,103 @@
+"""
+Maintenance of the monthly transactions partitions (migration 6).
+
+Usage: python partitions.py           # create upcoming partitions, archive expired ones
+       python partitions.py status    # list partitions with their approximate row counts
+
+Partitions are created PARTITION_MONTHS_AHEAD months in advance. With TRANSACTIONS_RETAIN_MONTHS
+set, partitions that ended more than that many months ago are detached and moved to the
+`archive` schema: still queryable for audits, but no longer planned, scanned or vacuumed with
+the live table. The default (0) keeps all history attached.
+"""
+import os
+import re
+import sys
+import logging
+from datetime import date
+from migrations import get_conn
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+TRANSACTIONS_RETAIN_MONTHS = int(os.getenv("TRANSACTIONS_RETAIN_MONTHS", 0))
+ARCHIVE_SCHEMA = "archive"
+
+_PARTITION_NAME = re.compile(r"^transactions_y(\d{4})m(\d{2})$")
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_partitions(cur, start, end):
+    """Creates the monthly partitions covering start..end. Returns the names created."""
+    cur.execute("""
+        SELECT name FROM (
+            SELECT create_transactions_partition(m::date) AS name
+            FROM generate_series(date_trunc('month', %s::date), date_trunc('month', %s::date), interval '1 month') m
+        ) created WHERE name IS NOT NULL
+    """, (start, end))
+    return [row[0] for row in cur.fetchall()]
+
+
+def monthly_partitions(cur):
+    """(name, first day of month, approximate rows or None) of the attached monthly partitions, oldest first."""
+    cur.execute("""
+        SELECT c.relname, c.reltuples::bigint FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'transactions'::regclass
+    """)
+    partitions = []
+    for name, rows in cur.fetchall():
+        match = _PARTITION_NAME.match(name)
+        if match:
+            # reltuples is -1 until the partition is first analyzed
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1), rows if rows >= 0 else None))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def archive_partitions(cur, before):
+    """Detaches the partitions of months ending on or before `before` into the archive schema."""
+    archived = []
+    for name, month, _ in monthly_partitions(cur):
+        if add_months(month, 1) > before:
+            break
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}")
+        cur.execute(f'ALTER TABLE transactions DETACH PARTITION "{name}"')
+        cur.execute(f'ALTER TABLE "{name}" SET SCHEMA {ARCHIVE_SCHEMA}')
+        archived.append(name)
+    return archived
+
+
+def maintain(conn, months_ahead=PARTITION_MONTHS_AHEAD, retain_months=TRANSACTIONS_RETAIN_MONTHS):
+    """Returns (partitions created, partitions archived)."""
+    this_month = date.today().replace(day=1)
+    with conn:
+        with conn.cursor() as cur:
+            created = create_partitions(cur, this_month, add_months(this_month, months_ahead))
+            archived = archive_partitions(cur, add_months(this_month, -retain_months)) if retain_months else []
+    for name in created:
+        logging.info(f"Created partition {name}")
+    for name in archived:
+        logging.info(f"Archived partition {name} to {ARCHIVE_SCHEMA}.{name}")
+    return created, archived
+
+
+def status(conn):
+    with conn:
+        with conn.cursor() as cur:
+            for name, month, rows in monthly_partitions(cur):
+                print(f"{month:%Y-%m}  {name:<24}{'?' if rows is None else rows:>12}")
+            cur.execute("SELECT count(*) FROM transactions_default")
+            print(f"default  {'transactions_default':<24}{cur.fetchone()[0]:>12}")
+
+
+if __name__ == "__main__":
+    conn = get_conn()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "status":
+            status(conn)
+        else:
+            maintain(conn)
+    finally:
+        conn.close()
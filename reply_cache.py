@@ -0,0 +1,89 @@
+"""
+Read-through cache for WhatsApp read-command replies (list, show, summary).
+
+Keys embed the user's cache generation, a counter kept in user_settings that every write
+path bumps. The webhook loads user_settings on every message anyway, so a bump makes all
+older entries unreachable on every instance at once; nothing is deleted or broadcast.
+
+The in-process tier is an LRU with a TTL. REPLY_CACHE_SHARED=1 adds a Postgres-backed tier
+so short-lived serverless instances can reuse each other's replies.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from metrics import REPLY_CACHE_REQUESTS
+
+REPLY_CACHE_TTL_SECONDS = int(os.getenv("REPLY_CACHE_TTL_SECONDS", 300))
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", 10000))
+REPLY_CACHE_SHARED = os.getenv("REPLY_CACHE_SHARED", "").lower() in ("1", "true", "yes")
+
+
+class LRUCache:
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+_local = LRUCache(REPLY_CACHE_MAX_ENTRIES, REPLY_CACHE_TTL_SECONDS)
+
+
+def cache_key(user_id, generation, event_id, command, today):
+    return f"{user_id}:{generation}:{event_id}:{today.isoformat()}:{' '.join(command.split())}"
+
+
+async def get_reply(c, key):
+    reply = _local.get(key)
+    if reply is not None:
+        REPLY_CACHE_REQUESTS.inc("local", "hit")
+        return reply
+    REPLY_CACHE_REQUESTS.inc("local", "miss")
+    if not REPLY_CACHE_SHARED:
+        return None
+
+    await c.execute("SELECT reply FROM reply_cache WHERE cache_key = %s AND expires_at > now()", (key,))
+    row = await c.fetchone()
+    if row:
+        REPLY_CACHE_REQUESTS.inc("shared", "hit")
+        _local.set(key, row[0])
+        return row[0]
+    REPLY_CACHE_REQUESTS.inc("shared", "miss")
+    return None
+
+
+async def put_reply(c, key, reply):
+    _local.set(key, reply)
+    if REPLY_CACHE_SHARED:
+        # Expired rows are trimmed a few at a time by the writes themselves.
+        await c.execute("""
+            WITH expired AS (
+                DELETE FROM reply_cache WHERE cache_key IN (
+                    SELECT cache_key FROM reply_cache WHERE expires_at < now()
+                    LIMIT 20 FOR UPDATE SKIP LOCKED
+                )
+            )
+            INSERT INTO reply_cache (cache_key, reply, expires_at)
+            VALUES (%s, %s, now() + %s * interval '1 second')
+            ON CONFLICT (cache_key) DO UPDATE SET reply = EXCLUDED.reply, expires_at = EXCLUDED.expires_at
+        """, (key, reply, REPLY_CACHE_TTL_SECONDS))
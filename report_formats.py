@@ -0,0 +1,99 @@
+import io
+from abc import ABC, abstractmethod
+import pandas as pd
+
+TRANSACTION_COLUMNS = ["tran_id", "date", "action", "item", "amount", "merchant", "event"]
+SUMMARY_COLUMNS = ["month", "total_amount"]
+
+
+class ReportFormat(ABC):
+    """
+    A serialisation of the transactions report.
+    write() takes the transactions and monthly summary frames and returns file bytes,
+    read() turns those bytes back into the transactions frame. A format missing either
+    fails when it is instantiated.
+    """
+    name = None
+    extension = None
+    mimetype = None
+
+    @abstractmethod
+    def write(self, transactions_df, summary_df) -> bytes:
+        ...
+
+    @abstractmethod
+    def read(self, data: bytes) -> pd.DataFrame:
+        ...
+
+
+class ParquetFormat(ReportFormat):
+    """Columnar machine-readable state. Only the transactions are stored, the summary is derived."""
+    name = "parquet"
+    extension = "parquet"
+    mimetype = "application/vnd.apache.parquet"
+
+    def write(self, transactions_df, summary_df):
+        stream = io.BytesIO()
+        transactions_df.to_parquet(stream, index=False, engine="pyarrow", compression="zstd")
+        return stream.getvalue()
+
+    def read(self, data):
+        return pd.read_parquet(io.BytesIO(data), engine="pyarrow")
+
+
+class CsvGzFormat(ReportFormat):
+    """Gzipped CSV of the transactions, for lightweight sharing."""
+    name = "csv.gz"
+    extension = "csv.gz"
+    mimetype = "application/gzip"
+
+    def write(self, transactions_df, summary_df):
+        stream = io.BytesIO()
+        # mtime=0 keeps the gzip header stable so unchanged reports hash the same
+        transactions_df.to_csv(stream, index=False, date_format="%Y-%m-%d",
+                               compression={"method": "gzip", "mtime": 0})
+        return stream.getvalue()
+
+    def read(self, data):
+        return pd.read_csv(io.BytesIO(data), compression="gzip", parse_dates=["date"])
+
+
+class XlsxFormat(ReportFormat):
+    """Rendered workbook with a Transactions sheet and a MonthlySummary sheet."""
+    name = "xlsx"
+    extension = "xlsx"
+    mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    def write(self, transactions_df, summary_df):
+        stream = io.BytesIO()
+        with pd.ExcelWriter(stream, engine="openpyxl") as writer:
+            transactions_df.to_excel(writer, sheet_name="Transactions", index=False)
+            summary_df.to_excel(writer, sheet_name="MonthlySummary", index=False)
+        return stream.getvalue()
+
+    def read(self, data):
+        xl = pd.read_excel(io.BytesIO(data), sheet_name=None)
+        return xl.get("Transactions", pd.DataFrame(columns=TRANSACTION_COLUMNS))
+
+
+FORMATS = {fmt.name: fmt for fmt in (ParquetFormat(), CsvGzFormat(), XlsxFormat())}
+
+
+def get_format(name):
+    try:
+        return FORMATS[name.strip().lower()]
+    except KeyError:
+        raise ValueError(f"Unknown report format '{name}'. Available: {', '.join(FORMATS)}")
+
+
+def empty_transactions():
+    return pd.DataFrame(columns=TRANSACTION_COLUMNS)
+
+
+def monthly_summary(transactions_df):
+    if transactions_df.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    month = transactions_df["date"].dt.to_period("M").astype(str).rename("month")
+    summary = transactions_df.groupby(month)["amount"].sum().reset_index()
+    summary.columns = SUMMARY_COLUMNS
+    return summary
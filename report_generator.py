@@ -3,18 +3,40 @@ import pandas as pd
 import json
 import os
 import io
+import time
+import hashlib
 import logging
+import itertools
 from datetime import datetime
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
+from report_formats import get_format, empty_transactions, monthly_summary, TRANSACTION_COLUMNS
 
 # Configuration
 API_BASE = "https://expenseapp-git-main-subhajits-projects-82cd4a28.vercel.app"
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/drive']
 FOLDER_NAME = "ExpenseReports"
 
+# Parquet is the machine-readable state that is read back every run.
+# View formats are rendered from it for people to open, e.g. "xlsx,csv.gz" (empty for none).
+STATE_FORMAT = get_format("parquet")
+VIEW_FORMATS = [get_format(name) for name in os.getenv("REPORT_VIEW_FORMATS", "xlsx").split(",") if name.strip()]
+LEGACY_FORMAT = get_format("xlsx")
+# Drive appProperties key holding frame_hash() of the uploaded report
+CONTENT_HASH_PROPERTY = "content_hash"
+
+# Resumable upload tuning. Drive requires chunk sizes in multiples of 256 KiB.
+UPLOAD_CHUNK_ALIGN = 256 * 1024
+UPLOAD_CHUNK_SIZE = max(
+    UPLOAD_CHUNK_ALIGN,
+    int(os.getenv("DRIVE_UPLOAD_CHUNK_SIZE", 5 * 1024 * 1024)) // UPLOAD_CHUNK_ALIGN * UPLOAD_CHUNK_ALIGN
+)
+UPLOAD_MAX_RETRIES = int(os.getenv("DRIVE_UPLOAD_MAX_RETRIES", 5))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
 # Logging setup
 logging.basicConfig(
     level=logging.INFO,
@@ -71,77 +93,156 @@ def get_transactions(user_id):
             break
         page += 1
 
-def find_or_create_excel_file(drive_service, folder_id, username):
-    filename = f"transactions_{username}.xlsx"
-    query = f"name='{filename}' and '{folder_id}' in parents and mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'"
-    result = drive_service.files().list(q=query, spaces='drive').execute()
-    files = result.get("files", [])
+def report_filename(username, fmt):
+    return f"transactions_{username}.{fmt.extension}"
 
+def find_report_file(drive_service, folder_id, filename):
+    """Returns (file_id, content hash recorded at upload) of the report in the folder, or (None, None)."""
+    query = f"name='{filename}' and '{folder_id}' in parents and trashed=false"
+    result = drive_service.files().list(q=query, spaces='drive', fields='files(id, appProperties)').execute()
+    files = result.get("files", [])
     if files:
-        logging.info(f"✅ Excel file found: {files[0]['id']}")
-        return files[0]["id"]
-    else:
-        logging.info("📄 Creating new Excel file.")
-        df = pd.DataFrame(columns=["date", "action", "item", "amount", "merchant", "event"])
-        summary_df = pd.DataFrame(columns=["month", "total_amount"])
-        stream = io.BytesIO()
-        with pd.ExcelWriter(stream, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name="Transactions", index=False)
-            summary_df.to_excel(writer, sheet_name="MonthlySummary", index=False)
-        stream.seek(0)
-
-        file_metadata = {
-            'name': filename,
-            'parents': [folder_id],
-            'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        }
-        media = MediaIoBaseUpload(stream, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-        logging.info(f"✅ Excel file created: {file['id']}")
-        return file['id']
-
-def update_excel_file(drive_service, file_id, transactions_streams):
-    logging.info("⬇️ Downloading current Excel file from Drive.")
+        return files[0]["id"], (files[0].get("appProperties") or {}).get(CONTENT_HASH_PROPERTY)
+    return None, None
+
+def frame_hash(transactions_df):
+    """
+    Hash of the report's columns and values. The file bytes can't be compared:
+    openpyxl stamps the workbook's modified time and zip entry times on every write.
+    """
+    digest = hashlib.md5(",".join(transactions_df.columns).encode())
+    digest.update(pd.util.hash_pandas_object(transactions_df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def download_file(drive_service, file_id):
     request = drive_service.files().get_media(fileId=file_id)
     fh = io.BytesIO()
     downloader = MediaIoBaseDownload(fh, request)
     done = False
     while not done:
         _, done = downloader.next_chunk()
-    fh.seek(0)
+    return fh.getvalue()
+
+def upload_resumable(upload_request):
+    """
+    Drives a resumable Drive upload chunk by chunk.
+    On a transient failure the next call to next_chunk() first asks Drive for the
+    last acknowledged offset, so only the unacknowledged tail is re-sent.
+    """
+    response = None
+    retries = 0
+    while response is None:
+        try:
+            status, response = upload_request.next_chunk()
+            retries = 0
+            if status:
+                logging.info(f"⬆️ Uploaded {int(status.progress() * 100)}%")
+        except HttpError as e:
+            if e.resp.status not in RETRYABLE_STATUS_CODES or retries >= UPLOAD_MAX_RETRIES:
+                raise
+            retries += 1
+            logging.warning(f"⚠️ Upload chunk failed with status {e.resp.status}, retry {retries}/{UPLOAD_MAX_RETRIES}")
+            time.sleep(2 ** retries)
+        except (ConnectionError, TimeoutError, OSError) as e:
+            if retries >= UPLOAD_MAX_RETRIES:
+                raise
+            retries += 1
+            logging.warning(f"⚠️ Upload chunk failed ({e}), retry {retries}/{UPLOAD_MAX_RETRIES}")
+            time.sleep(2 ** retries)
+    return response
+
+def upload_report(drive_service, folder_id, filename, fmt, transactions_df, summary_df, file_id=None, remote_hash=None):
+    """
+    Renders and creates or updates a report file. Returns (file_id, uploaded).
+    Nothing is rendered or uploaded when frame_hash() matches the hash stored on the Drive file.
+    """
+    content_hash = frame_hash(transactions_df)
+    if file_id and content_hash == remote_hash:
+        logging.info(f"⏭️ {filename} unchanged. Skipping upload.")
+        return file_id, False
+
+    data = fmt.write(transactions_df, summary_df)
+    logging.info(f"⬆️ Uploading {filename} ({len(data)} bytes).")
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype=fmt.mimetype, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+    properties = {'appProperties': {CONTENT_HASH_PROPERTY: content_hash}}
+    if file_id:
+        upload_resumable(drive_service.files().update(fileId=file_id, body=properties, media_body=media))
+    else:
+        file_metadata = {'name': filename, 'parents': [folder_id], 'mimeType': fmt.mimetype, **properties}
+        file_id = upload_resumable(drive_service.files().create(body=file_metadata, media_body=media, fields='id'))['id']
+    logging.info(f"✅ {filename} uploaded: {file_id}")
+    return file_id, True
+
+def load_state(drive_service, folder_id, username):
+    """
+    Returns (file_id, content hash, transactions_df) of the parquet state.
+    A user with only the older xlsx report is seeded from that workbook.
+    """
+    file_id, remote_hash = find_report_file(drive_service, folder_id, report_filename(username, STATE_FORMAT))
+    if file_id:
+        logging.info(f"⬇️ Downloading report state {file_id}.")
+        return file_id, remote_hash, STATE_FORMAT.read(download_file(drive_service, file_id))
+
+    legacy_id, _ = find_report_file(drive_service, folder_id, report_filename(username, LEGACY_FORMAT))
+    if legacy_id:
+        logging.info(f"⬇️ Seeding report state from existing workbook {legacy_id}.")
+        legacy_df = LEGACY_FORMAT.read(download_file(drive_service, legacy_id))
+        return None, None, legacy_df.drop(columns=["month"], errors="ignore")
+
+    logging.info("📄 No report state yet. Starting empty.")
+    return None, None, empty_transactions()
+
+def update_reports(drive_service, folder_id, username, transactions_streams):
+    """
+    Appends today's transactions the report state doesn't hold yet and re-renders the views.
+    Returns the file id to share with the user, or None when nothing changed, e.g. on a rerun the same day.
+    """
+    # Skip the download, rebuild and upload entirely when there is nothing new.
+    first_page = next(transactions_streams, None)
+    if first_page is None:
+        logging.info("⏭️ No new transactions. Skipping rebuild and upload.")
+        return None
+    transactions_streams = itertools.chain([first_page], transactions_streams)
 
     try:
-        xl = pd.read_excel(fh, sheet_name=None)
-        existing_df = xl.get("Transactions", pd.DataFrame())
-        summary_df = xl.get("MonthlySummary", pd.DataFrame())
+        state_id, state_hash, existing_df = load_state(drive_service, folder_id, username)
     except Exception as e:
-        logging.error(f"❌ Failed to read Excel file: {e}")
-        return
+        logging.error(f"❌ Failed to read report state: {e}")
+        return None
 
-    # Process new transactions
+    # Process new transactions. Rows the state already holds are dropped, so a rerun
+    # leaves the state unchanged and its upload is skipped.
     logging.info("📊 Appending transactions page by page.")
+    if "tran_id" not in existing_df.columns:
+        existing_df["tran_id"] = pd.NA  # state written before tran_ids were kept
+    seen = set(existing_df["tran_id"].dropna().astype(int))
     for df_new in transactions_streams:
+        df_new = df_new[~df_new["tran_id"].isin(seen)].drop_duplicates(subset=["tran_id"])
+        seen.update(df_new["tran_id"])
         existing_df = pd.concat([existing_df, df_new], ignore_index=True)
 
-    # Refresh monthly summary
-    logging.info("📈 Recomputing monthly summary.")
+    existing_df = existing_df[TRANSACTION_COLUMNS]
+    existing_df['tran_id'] = existing_df['tran_id'].astype("Int64")
     existing_df['date'] = pd.to_datetime(existing_df['date'], errors='coerce')
     existing_df = existing_df.dropna(subset=['date'])
-    existing_df['month'] = existing_df['date'].dt.to_period('M')
-    summary = existing_df.groupby('month')['amount'].sum().reset_index()
-    summary.columns = ["month", "total_amount"]
-
-    # Upload updated file
-    logging.info("⬆️ Uploading updated Excel file.")
-    updated_fh = io.BytesIO()
-    with pd.ExcelWriter(updated_fh, engine='openpyxl') as writer:
-        existing_df.to_excel(writer, sheet_name="Transactions", index=False)
-        summary.to_excel(writer, sheet_name="MonthlySummary", index=False)
-    updated_fh.seek(0)
-
-    media = MediaIoBaseUpload(updated_fh, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    drive_service.files().update(fileId=file_id, media_body=media).execute()
-    logging.info("✅ Excel file updated and uploaded.")
+    existing_df['amount'] = existing_df['amount'].astype(float)
+
+    # Refresh monthly summary
+    logging.info("📈 Recomputing monthly summary.")
+    summary = monthly_summary(existing_df)
+
+    state_id, state_changed = upload_report(drive_service, folder_id, report_filename(username, STATE_FORMAT), STATE_FORMAT,
+                                            existing_df, summary, state_id, state_hash)
+    if not state_changed:
+        return None
+
+    view_ids = []
+    for fmt in VIEW_FORMATS:
+        filename = report_filename(username, fmt)
+        view_id, view_hash = find_report_file(drive_service, folder_id, filename)
+        view_id, _ = upload_report(drive_service, folder_id, filename, fmt, existing_df, summary, view_id, view_hash)
+        view_ids.append(view_id)
+    return view_ids[0] if view_ids else state_id
 
 def notify_user(user_id, file_id):
     try:
@@ -179,10 +280,10 @@ def scheduler():
         try:
             drive_service = get_drive_service(token_json)
             folder_id = get_or_create_folder(drive_service)
-            file_id = find_or_create_excel_file(drive_service, folder_id, username)
             transaction_pages = get_transactions(user_id)
-            update_excel_file(drive_service, file_id, transaction_pages)
-            notify_user(user_id, file_id)
+            file_id = update_reports(drive_service, folder_id, username, transaction_pages)
+            if file_id:
+                notify_user(user_id, file_id)
             logging.info(f"✅ Completed processing for user {user_id}")
         except Exception as e:
             logging.error(f"❌ Error processing user {user_id}: {e}")
@@ -0,0 +1,114 @@
+"""
+Per-request SQL profiling.
+
+ProfilingCursor is installed as the cursor_factory of every connection. While a profile is
+active (see start_profile / end_profile) it counts and times each statement, logs statements
+slower than SLOW_QUERY_MS with their parameter-free fingerprint, and checks the route's
+query budget. With SQL_QUERY_BUDGET_ENFORCE=1 (CI, load tests) going over budget raises
+QueryBudgetExceeded before the extra round trip is made.
+"""
+import os
+import re
+import time
+import logging
+import functools
+import contextvars
+import psycopg2.extensions
+from metrics import DB_QUERY_LATENCY, DB_ERRORS, DB_QUERIES_PER_REQUEST
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+ENFORCE_QUERY_BUDGET = os.getenv("SQL_QUERY_BUDGET_ENFORCE", "").lower() in ("1", "true", "yes")
+
+_current_profile = contextvars.ContextVar("sql_profile", default=None)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_CAST = re.compile(r"\?::\w+(?:\[\])?")
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestProfile:
+    def __init__(self, route, budget=None):
+        self.route = route
+        self.budget = budget
+        self.query_count = 0
+        self.total_seconds = 0.0
+        self.statements = []
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.query_count > self.budget
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """Normalises a statement so calls that differ only in their values group together."""
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", errors="replace")
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _CAST.sub("?", sql)
+    sql = _VALUE_LIST.sub("(...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def start_profile(route, budget=None):
+    return _current_profile.set(RequestProfile(route, budget))
+
+
+def end_profile(token):
+    profile = _current_profile.get()
+    _current_profile.reset(token)
+    if profile is None:
+        return None
+    DB_QUERIES_PER_REQUEST.observe(profile.query_count, profile.route)
+    if profile.over_budget:
+        logging.warning(f"Query budget exceeded on {profile.route}: {profile.query_count} > {profile.budget}\n"
+                        + "\n".join(f"  {seconds * 1000:.1f} ms  {fingerprint(sql)}" for sql, seconds in profile.statements))
+    return profile
+
+
+def current_profile():
+    return _current_profile.get()
+
+
+def record_statement(sql, seconds):
+    profile = _current_profile.get()
+    route = profile.route if profile else "none"
+    DB_QUERY_LATENCY.observe(seconds, route)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        logging.warning(f"Slow query {seconds * 1000:.1f} ms [{route}]: {fingerprint(sql)}")
+    if profile:
+        profile.total_seconds += seconds
+        profile.statements.append((sql, seconds))
+
+
+def check_budget(sql):
+    profile = _current_profile.get()
+    if profile is None:
+        return
+    profile.query_count += 1
+    if ENFORCE_QUERY_BUDGET and profile.over_budget:
+        raise QueryBudgetExceeded(
+            f"{profile.route} issued {profile.query_count} queries (budget {profile.budget}): {fingerprint(sql)}")
+
+
+class ProfilingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts, times and budget-checks every statement of the active request."""
+    def execute(self, query, vars=None):
+        check_budget(query)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except Exception:
+            DB_ERRORS.inc("query")
+            raise
+        finally:
+            record_statement(query, time.perf_counter() - start)